@@ -1,16 +1,41 @@
+import asyncio
+
 from django.apps import apps
 from django.contrib import admin, messages
 from django.db import models
 from django.forms import widgets
 
-from community.app import dj_models
+from community.app import dj_models, settings
+from community.app.dj_routers import replica_reads
 
 
 class BaseAdmin(admin.ModelAdmin):
     formfield_overrides = {models.TextField: {'widget': widgets.TextInput}}
 
-
-class BaseMessageAdmin(BaseAdmin):
+    def changelist_view(self, request, extra_context=None):
+        # list pages read from the replica. actions (POST) and change pages
+        # stay on the primary. the response is rendered here because the
+        # queryset is only evaluated by the template
+        if request.method != 'GET':
+            return super().changelist_view(request, extra_context=extra_context)
+        with replica_reads():
+            response = super().changelist_view(request, extra_context=extra_context)
+            if hasattr(response, 'render'):
+                response.render()
+        return response
+
+
+class DeferRawDataMixin(object):
+    # list pages only show scalar columns. the change page still loads data
+    # on access
+    def get_queryset(self, request):
+        qs = super().get_queryset(request)
+        if settings.DB_DEFER_RAW_DATA:
+            qs = qs.defer('data')
+        return qs
+
+
+class BaseMessageAdmin(DeferRawDataMixin, BaseAdmin):
     list_display = ['user_id', 'message', 'timestamp']
     list_filter = ['job']
 
@@ -26,7 +51,7 @@ class BaseJobAdmin(BaseAdmin):
             tj.av_object.process()
 
 
-class BaseUserAdmin(BaseAdmin):
+class BaseUserAdmin(DeferRawDataMixin, BaseAdmin):
     list_display = ['id', 'username', 'name']
     list_filter = ['job']
     search_fields = ['id', 'username', 'name']
@@ -168,7 +193,7 @@ class DiscordJobAdmin(BaseJobAdmin):
     def crawl_messages(self, request, qs):
         messages.add_message(request, messages.INFO, 'crawl_tweets for [%s] jobs(s) has been queued' % len(qs))
         for tj in qs:
-            tj.av_object.start_crawl_with_discordpy()
+            asyncio.run(tj.av_object.start_crawl_with_discordpy())
 
     def populate_threads(self, request, qs):
         messages.add_message(request, messages.INFO, 'populate_threads for [%s] jobs(s) has been queued' % len(qs))
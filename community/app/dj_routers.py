@@ -1,4 +1,35 @@
+from contextlib import contextmanager
+import contextvars
+
+from django.db import connections
+
+from community.platform.utils.replica_utils import REPLICA_LAG_SQL, ReplicaLagCheck
+
+COMMUNITY_DBS = {'community', 'community_replica'}
+_USE_REPLICA = contextvars.ContextVar('use_replica', default=False)
+
+
+def get_replica_lag():
+    with connections['community_replica'].cursor() as cursor:
+        cursor.execute(REPLICA_LAG_SQL)
+        return cursor.fetchone()[0]
+
+
+@contextmanager
+def replica_reads():
+    # reads of community models inside this block may go to the replica.
+    # everything else reads from the primary, so a page shown right after a
+    # save never sees stale data
+    token = _USE_REPLICA.set(True)
+    try:
+        yield
+    finally:
+        _USE_REPLICA.reset(token)
+
+
 class CommunityRouter:
+    replica_lag_check = ReplicaLagCheck('community_replica', get_replica_lag)
+
     @staticmethod
     def is_django_managed_model(model):
         table = model._meta.db_table
@@ -9,13 +40,21 @@ class CommunityRouter:
         table = model._meta.db_table
         return table.startswith('rainman_')
 
+    def get_community_read_db(self):
+        # reads marked with replica_reads() go to the replica unless it lags behind
+        if not _USE_REPLICA.get():
+            return 'community'
+        if 'community_replica' in connections.databases and self.replica_lag_check.is_usable():
+            return 'community_replica'
+        return 'community'
+
     def db_for_read(self, model, **hints):
         if self.is_django_managed_model(model):
             return None
         elif self.is_rainman_model(model):
             return 'rainman'
         else:
-            return 'community'
+            return self.get_community_read_db()
 
     def db_for_write(self, model, **hints):
         if self.is_django_managed_model(model):
@@ -26,10 +65,12 @@ class CommunityRouter:
             return 'community'
 
     def allow_relation(self, obj1, obj2, **hints):
+        if obj1._state.db in COMMUNITY_DBS and obj2._state.db in COMMUNITY_DBS:
+            return True
         return None
 
     def allow_migrate(self, db, app_label, model_name=None, **hints):
-        if db == 'community':
+        if db in COMMUNITY_DBS:
             return False
         elif db == 'rainman':
             return False
@@ -83,6 +83,9 @@ DATABASES = {
     'community': dj_database_url.parse(settings.DATABASE_URL),
     'rainman': dj_database_url.parse(settings.RAINMAN_DATABASE_URL),
 }
+if settings.DATABASE_REPLICA_URL:
+    DATABASES['community_replica'] = dj_database_url.parse(settings.DATABASE_REPLICA_URL)
+    DATABASES['community_replica']['TEST'] = {'MIRROR': 'community'}
 DATABASE_ROUTERS = ['community.app.dj_routers.CommunityRouter']
 
 # Password validation
@@ -1,3 +1,4 @@
+import json
 import logging
 import os
 import warnings
@@ -33,8 +34,19 @@ PID_DIR = 'pids/'
 
 # infra
 DATABASE_URL = os.getenv('DATABASE_URL')
+DATABASE_REPLICA_URL = os.getenv('DATABASE_REPLICA_URL')
 DJANGO_DATABASE_URL = os.getenv('DJANGO_DATABASE_URL')
 RAINMAN_DATABASE_URL = os.getenv('RAINMAN_DATABASE_URL')
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 30 * 60))
+DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true'
+DB_PARTITION_MONTHS_AHEAD = int(os.getenv('DB_PARTITION_MONTHS_AHEAD', 3))
+DB_DEFER_RAW_DATA = os.getenv('DB_DEFER_RAW_DATA', 'true').lower() == 'true'
+REPLICA_MAX_LAG_SECONDS = int(os.getenv('REPLICA_MAX_LAG_SECONDS', 30))
+REPLICA_LAG_CHECK_INTERVAL = int(os.getenv('REPLICA_LAG_CHECK_INTERVAL', 10))
+PROFILE_REFRESH_TTL_DAYS = int(os.getenv('PROFILE_REFRESH_TTL_DAYS', 7))
 
 REDIS_HOST = os.getenv('REDIS_HOST', 'localhost')
 REDIS_PORT = os.getenv('REDIS_PORT', 6379)
@@ -52,6 +64,32 @@ TWITTER_SECRET_KEY = os.getenv('TWITTER_SECRET_KEY')
 TWITTER_BEARER_TOKEN = os.getenv('TWITTER_BEARER_TOKEN')
 TWITTER_ACCESS_TOKEN = os.getenv('TWITTER_ACCESS_TOKEN')
 TWITTER_ACCESS_TOKEN_SECRET = os.getenv('TWITTER_ACCESS_TOKEN_SECRET')
+# json list of {"name", "api_key", "secret_key", "bearer_token", "access_token",
+# "access_token_secret"} to spread api calls over. defaults to the keys above
+TWITTER_CREDENTIALS = json.loads(os.getenv('TWITTER_CREDENTIALS', 'null')) or [{
+    'name': 'default',
+    'api_key': TWITTER_API_KEY,
+    'secret_key': TWITTER_SECRET_KEY,
+    'bearer_token': TWITTER_BEARER_TOKEN,
+    'access_token': TWITTER_ACCESS_TOKEN,
+    'access_token_secret': TWITTER_ACCESS_TOKEN_SECRET,
+}]
+TWITTER_RATE_LIMIT_BACKEND = os.getenv('TWITTER_RATE_LIMIT_BACKEND', 'redis')
+# twint or api
+TWITTER_CRAWL_BACKEND = os.getenv('TWITTER_CRAWL_BACKEND', 'twint')
+# upper bound, the crawl runs fewer workers when the credentials have less budget left
+TWITTER_REACTION_CRAWL_CONCURRENCY = int(os.getenv('TWITTER_REACTION_CRAWL_CONCURRENCY', 8))
+TWITTER_REACTION_RECRAWL_MAX_AGE_DAYS = int(os.getenv('TWITTER_REACTION_RECRAWL_MAX_AGE_DAYS', 7))
+# points the stream listener at a mock server when testing offline
+TWITTER_API_BASE_URL = os.getenv('TWITTER_API_BASE_URL', 'https://api.twitter.com')
+TWITTER_STREAM_BATCH_SIZE = int(os.getenv('TWITTER_STREAM_BATCH_SIZE', 100))
+TWITTER_STREAM_FLUSH_INTERVAL = int(os.getenv('TWITTER_STREAM_FLUSH_INTERVAL', 10))
+TWITTER_STREAM_RULES_REFRESH_INTERVAL = int(os.getenv('TWITTER_STREAM_RULES_REFRESH_INTERVAL', 15 * 60))
+# one worker per crawl type (tweets, mentions, replies) where the cpus allow it
+TWINT_MAX_PARALLEL_CRAWLS = int(os.getenv('TWINT_MAX_PARALLEL_CRAWLS', min(3, os.cpu_count() or 1)))
+TWINT_BACKFILL_MIN_DAYS = int(os.getenv('TWINT_BACKFILL_MIN_DAYS', 30))
+TWINT_BACKFILL_TWEETS_PER_WINDOW = int(os.getenv('TWINT_BACKFILL_TWEETS_PER_WINDOW', 5000))
+TWINT_BACKFILL_WORKERS = int(os.getenv('TWINT_BACKFILL_WORKERS', 4))
 
 DISCORD_BEARER_TOKEN = os.getenv('DISCORD_BEARER_TOKEN')
 DISCORD_BOT_TOKEN = os.getenv('DISCORD_BOT_TOKEN')
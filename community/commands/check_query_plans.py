@@ -0,0 +1,60 @@
+import typer
+
+
+def get_latest_job(model):
+    return model.filter().order_by(model.id.desc()).first()
+
+
+def get_hot_queries():
+    from community.ingest.discord.models import DiscordJob
+    from community.ingest.github.models import GithubJob, GithubEvent, GithubMessage, GithubRelation
+    from community.ingest.twitter.models import TwitterHandle, TwitterJob
+
+    job = get_latest_job(TwitterJob)
+    if job is not None:
+        yield 'TwitterJob.populate_users', job.get_new_users_query()
+
+    handle = TwitterHandle.filter().first()
+    if handle is not None:
+        yield 'TwitterHandle.crawl_messages', handle.get_since_query()
+
+    job = get_latest_job(DiscordJob)
+    if job is not None:
+        yield 'DiscordJob.populate_reactions', job.get_new_reactions_query()
+        yield 'DiscordJob.populate_users', job.get_new_users_query()
+
+    job = get_latest_job(GithubJob)
+    if job is not None:
+        yield 'GithubJob.populate_users', job.get_new_users_query()
+    for model in [GithubEvent, GithubMessage, GithubRelation]:
+        yield 'GithubJob._filter_by_date:%s' % model.__name__, GithubJob.get_max_timestamp_query(model)
+
+
+def main(min_rows: int = typer.Option(10000, help='tables with fewer estimated rows may be seq scanned'),
+         analyze: bool = typer.Option(False, help='refresh planner statistics first')):
+    from community.platform.utils.orm_utils import get_engine
+    from community.platform.utils.plan_utils import explain, get_seq_scans, get_table_rows
+
+    engine = get_engine()
+    with engine.connect() as conn:
+        if analyze:
+            conn.exec_driver_sql('ANALYZE')
+        table_rows = get_table_rows(conn)
+
+        failed = []
+        for name, query in get_hot_queries():
+            plan = explain(conn, query)
+            seq_scans = get_seq_scans(plan, table_rows, min_rows)
+            for table, rows in seq_scans:
+                typer.echo('%s: seq scan on %s with ~%d rows' % (name, table, rows), err=True)
+            if seq_scans:
+                failed.append(name)
+            else:
+                typer.echo('%s: ok' % name)
+
+    if failed:
+        raise typer.Exit(code=1)
+
+
+if __name__ == "__main__":
+    typer.run(main)
@@ -3,11 +3,11 @@ import typer
 
 
 def main():
-    from community.ingest.twitter.models import TwitterHandle
+    from community.ingest.twitter.models import TwitterHandle, TwitterJob
 
     th_set = TwitterHandle.filter().all()
-    for th in tqdm(th_set):
-        th.crawl_messages()
+    jobs = [th.crawl_messages(process=False) for th in tqdm(th_set)]
+    TwitterJob.process_together(jobs)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,21 @@
+import typer
+
+app = typer.Typer()
+
+
+@app.command()
+def bootstrap():
+    from community.platform.utils.schema_utils import bootstrap
+
+    bootstrap()
+
+
+@app.command()
+def partitions():
+    from community.platform.utils.schema_utils import maintain_partitions
+
+    maintain_partitions()
+
+
+if __name__ == "__main__":
+    app()
@@ -0,0 +1,29 @@
+import typer
+
+app = typer.Typer()
+
+
+@app.command()
+def startstop():
+    from community.ingest.twitter.utils.stream_utils import StreamClient
+
+    client = StreamClient()
+    client.run()
+
+
+@app.command()
+def stop():
+    from community.ingest.twitter.utils.stream_utils import StreamClient
+    StreamClient.kill_previous()
+
+
+@app.command()
+def mock_server(host: str = '127.0.0.1', port: int = 8089, interval: float = 1.0):
+    # point TWITTER_API_BASE_URL at this to run the listener offline
+    from community.ingest.twitter.utils.mock_stream_server import run
+
+    run(host=host, port=port, interval=interval)
+
+
+if __name__ == "__main__":
+    app()
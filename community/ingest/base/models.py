@@ -1,15 +1,37 @@
+import datetime
 import logging
 
-from sqlalchemy import Column, Integer, ForeignKey, String, Text, DateTime, BigInteger
+from sqlalchemy import Column, Integer, ForeignKey, String, Text, DateTime, BigInteger, Index, or_
 from sqlalchemy.dialects.postgresql import JSONB
-from sqlalchemy.orm import relationship, declared_attr
+from sqlalchemy.orm import relationship, declared_attr, deferred
 from sqlalchemy_utils import ChoiceType
 
+from community.app import settings
 from community.models import Base
 
 _LOG = logging.getLogger(__name__)
 
 
+def make_index(cls, *cols, name=None, **kwargs):
+    if name is None:
+        name = '_'.join(cols)
+    return Index('ix_%s_%s' % (cls.__tablename__, name), *cols, **kwargs)
+
+
+class RawDataMixin(object):
+    # the raw api payload is most of the row but rarely needed once the
+    # scalar columns are filled, so it's only loaded when asked for
+    RAW_DATA_GROUP = 'raw'
+    RAW_DATA_NULLABLE = True
+
+    @declared_attr
+    def data(cls):
+        col = Column(JSONB, nullable=cls.RAW_DATA_NULLABLE)
+        if settings.DB_DEFER_RAW_DATA:
+            return deferred(col, group=cls.RAW_DATA_GROUP)
+        return col
+
+
 class BaseJob(Base):
     __abstract__ = True
 
@@ -45,14 +67,16 @@ class BaseJob(Base):
         raise NotImplementedError
 
     @classmethod
-    def add_job(cls, project_id, **kwargs):
+    def add_job(cls, project_id, process=True, **kwargs):
         job = cls.create(project_id=project_id, **kwargs)
-        job.process()
+        if process:
+            job.process()
+        return job
 
-    def _process(self):
+    def _process(self, **kwargs):
         raise NotImplementedError
 
-    def process(self):
+    def process(self, **kwargs):
         _LOG.info('starting crawl for %s', self)
         with self.saving():
             self.status = self.STATUS_RUNNING
@@ -67,11 +91,22 @@ class BaseJob(Base):
         #     status = self.STATUS_ERROR
         # else:
         #     status = self.STATUS_DONE
-        self._process()
+        self._process(**kwargs)
         status = self.STATUS_DONE
 
         with self.saving():
             self.status = status
+        self.log_pool_stats()
+
+    def log_pool_stats(self):
+        from community.platform.utils.orm_utils import get_pool_stats
+
+        # cumulative for the process. a high avg_wait means DB_POOL_SIZE is
+        # too small for the threads the crawl runs
+        stats = get_pool_stats()
+        _LOG.info('%s: db pool checkouts:[%s] avg_wait:[%.3fs] max_wait:[%.3fs] checked_out:[%s] overflow:[%s]',
+                  self, stats['checkouts'], stats['avg_wait'], stats['max_wait'],
+                  stats['checked_out'], stats['overflow'])
         # self.status = status
         # session.commit()
 
@@ -96,7 +131,7 @@ class BaseSource(Base):
         raise NotImplementedError
 
 
-class BaseUser(Base):
+class BaseUser(RawDataMixin, Base):
     __abstract__ = True
 
     JOB_MODEL = None
@@ -104,7 +139,7 @@ class BaseUser(Base):
     id = Column(BigInteger, primary_key=True, autoincrement=False)
     username = Column(Text)
     name = Column(Text)
-    data = Column(JSONB)
+    refreshed_at = Column(DateTime)
 
     @declared_attr
     def job_id(cls):
@@ -114,20 +149,57 @@ class BaseUser(Base):
     def job(cls):
         return relationship(cls.JOB_MODEL.__name__)
 
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'job_id'), make_index(cls, 'refreshed_at')]
+
+    @classmethod
+    def get_stale_query(cls, ttl_days=None):
+        # profiles that were never fetched or not within the ttl, whichever job they belong to
+        if ttl_days is None:
+            ttl_days = settings.PROFILE_REFRESH_TTL_DAYS
+        refreshed_since = datetime.datetime.now() - datetime.timedelta(days=ttl_days)
+        return cls.query(cls.id).filter(or_(cls.refreshed_at.is_(None), cls.refreshed_at < refreshed_since))
+
     def __repr__(self):
         return '<%s:%s>' % (self.__class__.__name__, self.username)
 
 
-class BaseMessage(Base):
+class BaseTimeSeries(Base):
+    __abstract__ = True
+
+    # store the table as monthly range partitions on timestamp. postgres
+    # wants the partition key in the primary key, so timestamp joins it
+    PARTITION_BY_MONTH = False
+    # btree serves max(timestamp) lookups. brin is a fraction of the size
+    # and enough for range scans over append-only tables
+    TIMESTAMP_INDEX_TYPE = 'btree'
+
+    @declared_attr
+    def timestamp(cls):
+        return Column(DateTime, nullable=False, primary_key=cls.PARTITION_BY_MONTH)
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'timestamp', postgresql_using=cls.TIMESTAMP_INDEX_TYPE)]
+
+    @classmethod
+    def get_table_options(cls):
+        options = super().get_table_options()
+        if cls.PARTITION_BY_MONTH:
+            options['postgresql_partition_by'] = 'RANGE (timestamp)'
+        return options
+
+
+class BaseMessage(RawDataMixin, BaseTimeSeries):
     __abstract__ = True
 
     JOB_MODEL = None
     USER_MODEL = None
+    RAW_DATA_NULLABLE = False
 
     id = Column(BigInteger, primary_key=True, autoincrement=False)
     message = Column(Text, nullable=False)
-    timestamp = Column(DateTime, nullable=False)
-    data = Column(JSONB, nullable=False)
 
     @declared_attr
     def job_id(cls):
@@ -147,6 +219,13 @@ class BaseMessage(Base):
 
     user_id = Column(BigInteger, nullable=False)
 
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [
+            make_index(cls, 'job_id', 'timestamp'),
+            make_index(cls, 'user_id'),
+        ]
+
     def __repr__(self):
         return '<%s:"%s" ON "%s">' % (self.__class__.__name__, self.message, self.timestamp)
 
@@ -194,6 +273,13 @@ class BaseRelation(Base):
     data = Column(JSONB)
     timestamp = Column(DateTime, nullable=False)
 
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [
+            make_index(cls, 'job_id', 'from_node_id'),
+            make_index(cls, 'timestamp'),
+        ]
+
     def __repr__(self):
         return '<%s:(%s)-[%s]->(%s)>' % (self.__class__.__name__, self.from_node_id, self.relation_type, self.to_node_id)
 
@@ -238,6 +324,10 @@ class BaseMessageReaction(Base):
 
     message_id = Column(BigInteger, nullable=False)
 
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'job_id', 'user_id')]
+
     def __repr__(self):
         return '<%s:"%s" ON "%s">' % (self.__class__.__name__, self.reaction, self.timestamp)
 
@@ -283,13 +373,20 @@ class BaseMessageThread(Base):
         return '<%s:%s -> %s>' % (self.__class__.__name__, self.parent_message_id, self.message_id)
 
 
-class BaseEvent(Base):
+class BaseEvent(BaseTimeSeries):
     __abstract__ = True
 
+    TIMESTAMP_INDEX_TYPE = 'brin'
+
     event = Column(Text, nullable=False, index=True)
     user_id = Column(BigInteger)
     data = Column(JSONB, nullable=False)
-    timestamp = Column(DateTime, nullable=False)
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [
+            make_index(cls, 'data', postgresql_using='gin', postgresql_ops={'data': 'jsonb_path_ops'}),
+        ]
 
     def __repr__(self):
         return '<%s:%s - %s>' % (self.__class__.__name__, self.event, self.data)
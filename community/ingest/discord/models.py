@@ -1,18 +1,20 @@
+import asyncio
 import copy
+import datetime
 from functools import cached_property
 import json
 import os
 
 from discord.channel import TextChannel
-from sqlalchemy import ForeignKey, Column, Integer, Text, literal, func, BigInteger
+from sqlalchemy import ForeignKey, Column, Integer, Text, literal, func, BigInteger, Computed, DateTime, and_, text
 from sqlalchemy.orm import relationship
-from sqlalchemy.sql import expression
+from sqlalchemy.sql import exists
 from tqdm import tqdm
 
 from community.app import settings
 from community.models import Base
 from community.ingest.base.models import BaseJob, BaseSource, BaseUser, BaseMessage, BaseMessageReaction,\
-    BaseMessageThread, BaseEvent
+    BaseMessageThread, BaseEvent, make_index
 
 
 class DiscordAPIObjectMixin(object):
@@ -22,7 +24,10 @@ class DiscordAPIObjectMixin(object):
     async def get_client(cls):
         from community.ingest.discord.utils.bot_client import BotClient
 
-        if DiscordAPIObjectMixin._CLIENT is None:
+        # the client is bound to the loop it was created in and each
+        # asyncio.run() gets a new one
+        client = DiscordAPIObjectMixin._CLIENT
+        if client is None or client.loop is not asyncio.get_running_loop():
             client = BotClient()
             await client.login(settings.DISCORD_BOT_TOKEN)
             DiscordAPIObjectMixin._CLIENT = client
@@ -54,16 +59,20 @@ class DiscordGuild(BaseSource, DiscordAPIObjectMixin):
 
         client = await cls.get_client()
         project_id = project.id if isinstance(project, Project) else project
+        # channels of a guild are discovered while the next page of guilds
+        # is being fetched
+        tasks = []
         async for g in client.fetch_guilds():
-            dg = DiscordGuild.get_or_create(id=g.id, name=g.name, project_id=project_id)
-            await dg.discover_channels()
+            dg = await DiscordGuild.async_get_or_create(id=g.id, name=g.name, project_id=project_id)
+            tasks.append(asyncio.create_task(dg.discover_channels()))
+        await asyncio.gather(*tasks)
 
     async def discover_channels(self):
         obj = await self.discord_object
         channels = await obj.fetch_channels()
-        for ch in channels:
-            if any([isinstance(ch, klass) for klass in self.INTERESTING_CHANNELS]):
-                DiscordChannel.get_or_create(id=ch.id, name=ch.name, guild_id=self.id)
+        await asyncio.gather(*[DiscordChannel.async_get_or_create(id=ch.id, name=ch.name, guild_id=self.id)
+                               for ch in channels
+                               if any([isinstance(ch, klass) for klass in self.INTERESTING_CHANNELS])])
 
     def crawl_messages(self, **kwargs):
         for ch in self.channels:
@@ -120,83 +129,101 @@ class DiscordJob(BaseJob):
             objs.append(DiscordMessage(job=self,
                                        id=int(d['id']),
                                        message=d['content'],
-                                       timestamp=parse_timestamp(d['timestamp']),
+                                       timestamp=DiscordMessage.get_created_at(int(d['id'])),
+                                       edited_at=parse_timestamp(d['edited_timestamp']) if d.get('edited_timestamp') else None,
                                        user_id=int(d['author']['id']),
                                        channel_id=int(d['channel_id']),
                                        data=d))
-        DiscordMessage.bulk_create(objs)
+        DiscordMessage.bulk_create(objs, strategy=DiscordMessage.BULK_STRATEGY_COPY)
 
     async def start_crawl_with_discordpy(self):
+        from community.platform.utils.orm_utils import dispose_async_engine
+
+        try:
+            await self._crawl_with_discordpy()
+        finally:
+            await dispose_async_engine()
+
+    async def _crawl_with_discordpy(self):
         channel_id = self.config['channel_id']
-        ch = DiscordChannel.filter(DiscordChannel.id == channel_id).one()
+        ch = await DiscordChannel.async_get(id=channel_id)
         obj = await ch.discord_object
+        # each chunk is written while the next one is fetched. waiting for
+        # the previous write before starting another keeps memory bounded
+        pending = None
         objs = []
-        async for m in obj.history():
+        async for m in obj.history(limit=None):
             objs.append(DiscordMessage(job=self,
                                        id=m.id,
                                        message=m.content,
-                                       timestamp=m.edited_at or m.created_at,
+                                       timestamp=DiscordMessage.get_created_at(m.id),
+                                       edited_at=m.edited_at,
                                        user_id=m.author.id,
                                        channel_id=m.channel.id,
                                        data={}))
-        DiscordMessage.bulk_create(objs)
+            if len(objs) >= DiscordMessage.BULK_INSERT_CHUNK_SIZE:
+                if pending is not None:
+                    await pending
+                pending = asyncio.create_task(DiscordMessage.async_bulk_create(objs))
+                objs = []
+        if pending is not None:
+            await pending
+        if objs:
+            await DiscordMessage.async_bulk_create(objs)
 
     def populate_threads(self):
         pass
 
+    def get_new_reactions_query(self):
+        existing = exists().where(and_(DiscordReaction.message_id == DiscordEvent.message_id,
+                                       DiscordReaction.reaction == DiscordEvent.emoji_name,
+                                       DiscordReaction.user_id == DiscordEvent.user_id))
+        return DiscordEvent.query(DiscordEvent.user_id,
+                                  DiscordEvent.emoji_name.label('reaction'),
+                                  DiscordEvent.timestamp,
+                                  DiscordEvent.message_id,
+                                  literal(self.id).label('job_id')) \
+                           .filter(~existing,
+                                   DiscordEvent.event == DiscordEvent.EVENT_REACTION_ADD)
+
     def populate_reactions(self):
-        existing = DiscordReaction.query(DiscordReaction.message_id,
-                                         DiscordReaction.reaction,
-                                         DiscordReaction.user_id)
-        message_id = DiscordEvent.data['message_id'].cast(Text).cast(BigInteger)
-        reaction = DiscordEvent.data['emoji']['name'].cast(Text)
-        new = DiscordEvent.query(DiscordEvent.user_id,
-                                 reaction.label('reaction'),
-                                 DiscordEvent.timestamp,
-                                 message_id.label('message_id'),
-                                 literal(self.id).label('job_id')) \
-                          .filter(expression.tuple_(message_id,
-                                                    reaction,
-                                                    DiscordEvent.user_id).notin_(existing),
-                                  DiscordEvent.event == 'MESSAGE_REACTION_ADD')
+        new = self.get_new_reactions_query()
         table = DiscordReaction.metadata.tables[DiscordReaction.__tablename__]
         insert_query = table.insert()\
                             .from_select(['user_id', 'reaction', 'timestamp', 'message_id', 'job_id'],
                                          new)
-        session = self.session_factory()
-        session.execute(insert_query)
-        session.commit()
+        with self.session_scope() as session:
+            session.execute(insert_query)
+
+    def get_new_users_query(self):
+        def is_new(user_id):
+            return ~exists().where(DiscordUser.id == user_id)
 
-    def populate_users(self):
-        existing = DiscordUser.query(DiscordUser.id).distinct()
         from_messages = DiscordMessage.query(DiscordMessage.user_id.label('id'),
-                                             DiscordMessage.data['author']['username'].label('username'),
+                                             DiscordMessage.author_username.label('username'),
                                              DiscordMessage.job_id) \
-                                      .filter(DiscordMessage.user_id.notin_(existing),
+                                      .filter(is_new(DiscordMessage.user_id),
                                               DiscordMessage.job == self) \
                                       .distinct()
         from_reactions = DiscordReaction.query(DiscordReaction.user_id.label('id'),
-                                               DiscordReaction.data['author']['username'].label('username'),
+                                               DiscordReaction.author_username.label('username'),
                                                DiscordReaction.job_id) \
-                                        .filter(DiscordReaction.user_id.notin_(existing),
+                                        .filter(is_new(DiscordReaction.user_id),
                                                 DiscordReaction.job == self) \
                                         .distinct()
-        from_all = from_messages.union(from_reactions)
+        return from_messages.union(from_reactions)
 
+    def populate_users(self):
+        from_all = self.get_new_users_query()
         du_table = self.metadata.tables[DiscordUser.__tablename__]
         cols = ['id', 'username', 'job_id']
         insert_query = du_table.insert().from_select(cols, from_all)
-        session = self.session_factory()
-        session.execute(insert_query)
-
-        trimmed_username = func.substr(DiscordUser.username, 2, func.char_length(DiscordUser.username) - 2)
-        DiscordUser.filter(DiscordUser.job == self, DiscordUser.username.like('"%"')) \
-                   .update({'username': trimmed_username}, synchronize_session='fetch')
-        session.commit()
+        with self.session_scope() as session:
+            session.execute(insert_query)
 
     def _process(self):
         # self.start_crawl_with_discord_scraper()
-        self.start_crawl_with_discordpy()
+        asyncio.run(self.start_crawl_with_discordpy())
         self.populate_threads()
         self.populate_reactions()
         self.populate_users()
@@ -209,9 +236,44 @@ class DiscordUser(BaseUser):
 class DiscordMessage(BaseMessage, DiscordAPIObjectMixin):
     JOB_MODEL = DiscordJob
     USER_MODEL = DiscordUser
+    PARTITION_BY_MONTH = True
+
+    # ids are snowflakes with the creation time in their upper bits
+    DISCORD_EPOCH = datetime.datetime(2015, 1, 1)
+    CREATED_AT_SQL = "timezone('UTC', to_timestamp(((%s >> 22) + 1420070400000) / 1000.0))"
 
     channel_id = Column(Integer, ForeignKey('discordchannel.id'), nullable=False)
     channel = relationship('DiscordChannel')
+    author_username = Column(Text, Computed("data -> 'author' ->> 'username'", persisted=True))
+    edited_at = Column(DateTime)
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'job_id', 'user_id', 'author_username')]
+
+    @classmethod
+    def get_created_at(cls, message_id):
+        # the partition key has to be the same whichever crawler saw the
+        # message and however often it was edited, so that (id, timestamp)
+        # stays as unique as the id itself
+        return cls.DISCORD_EPOCH + datetime.timedelta(milliseconds=message_id >> 22)
+
+    @classmethod
+    def get_fixups(cls):
+        # rows written before timestamp was the creation time. edited copies
+        # are dropped and the remaining row is moved to its creation time
+        created_at = cls.CREATED_AT_SQL % 'id'
+        return [('discordmessage_creation_timestamp', [
+            text('DELETE FROM discordmessage a USING discordmessage b '
+                 'WHERE a.id = b.id AND a.timestamp <> b.timestamp AND b.timestamp = %s' % (cls.CREATED_AT_SQL % 'b.id')),
+            text('DELETE FROM discordmessage a USING discordmessage b '
+                 'WHERE a.id = b.id AND a.timestamp > b.timestamp'),
+            text("UPDATE discordmessage SET "
+                 "edited_at = CASE WHEN timestamp > %s + interval '1 second' "
+                 "THEN coalesce(edited_at, timestamp) ELSE edited_at END, "
+                 "timestamp = %s "
+                 "WHERE timestamp <> %s" % (created_at, created_at, created_at)),
+        ])]
 
     @cached_property
     async def discord_object(self):
@@ -225,9 +287,29 @@ class DiscordReaction(BaseMessageReaction):
     USER_MODEL = DiscordUser
     MESSAGE_MODEL = DiscordMessage
 
+    author_username = Column(Text, Computed("data -> 'author' ->> 'username'", persisted=True))
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [
+            make_index(cls, 'message_id', 'reaction', 'user_id'),
+            make_index(cls, 'job_id', 'user_id', 'author_username'),
+        ]
+
 
 class DiscordEvent(BaseEvent):
+    EVENT_REACTION_ADD = 'MESSAGE_REACTION_ADD'
+
     id = Column(BigInteger, primary_key=True)
+    message_id = Column(BigInteger, Computed("(data ->> 'message_id')::bigint", persisted=True))
+    emoji_name = Column(Text, Computed("data -> 'emoji' ->> 'name'", persisted=True))
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [
+            make_index(cls, 'message_id', 'emoji_name', 'user_id',
+                       postgresql_where=text("event = '%s'" % cls.EVENT_REACTION_ADD)),
+        ]
 
 
 class DiscordThread(BaseMessageThread):
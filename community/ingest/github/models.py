@@ -1,12 +1,12 @@
 import itertools
 
 from elasticsearch_dsl import Q
-from sqlalchemy import Column, Text, Integer, ForeignKey, func, BigInteger
-from sqlalchemy.sql import functions
+from sqlalchemy import Column, Text, Integer, ForeignKey, BigInteger
+from sqlalchemy.sql import functions, exists
 from sqlalchemy.orm import relationship
 
 from community.ingest.base.models import BaseSource, BaseJob, BaseMessageReaction, BaseRelation,\
-    BaseMessage, BaseUser, BaseMessageThread, BaseEvent
+    BaseMessage, BaseUser, BaseMessageThread, BaseEvent, make_index
 
 
 class GithubRepo(BaseSource):
@@ -52,11 +52,13 @@ class GithubJob(BaseJob):
     def __repr__(self):
         return '<%s:%s:%s - %s>' % (self.__class__.__name__, self.project.name, self.config, self.status)
 
+    @staticmethod
+    def get_max_timestamp_query(model):
+        return model.query(functions.max(model.timestamp))
+
     def _filter_by_date(self, qs, model):
-        session = self.session_factory()
         try:
-            max_ts = session.query(model) \
-                            .with_entities(functions.max(model.timestamp)).one()[0]
+            max_ts = self.get_max_timestamp_query(model).one()[0]
         except IndexError:
             max_ts = None
 
@@ -89,7 +91,7 @@ class GithubJob(BaseJob):
                                     user_id=int(d.pop('user_id')),
                                     timestamp=parse_timestamp(d.pop('timestamp')),
                                     data={k: v for k, v in d.items() if d.get(k)}))
-        GithubEvent.bulk_create(objs)
+        GithubEvent.bulk_create(objs, strategy=GithubEvent.BULK_STRATEGY_COPY)
 
     def populate_relations(self):
         from community.platform.utils.search_utils import get_search, serialize_search_results
@@ -150,35 +152,34 @@ class GithubJob(BaseJob):
     def populate_threads(self):
         pass
 
-    def populate_users(self):
-        existing = GithubUser.query(GithubUser.id).distinct()
+    def get_new_users_query(self):
+        def is_new(user_id):
+            return ~exists().where(GithubUser.id == user_id)
+
         from_events = GithubEvent.query(GithubEvent.user_id.label('id'),
                                         GithubEvent.job_id) \
-                                 .filter(GithubEvent.user_id.notin_(existing),
+                                 .filter(is_new(GithubEvent.user_id),
                                          GithubEvent.job == self) \
                                  .distinct()
         from_messages = GithubMessage.query(GithubMessage.user_id.label('id'),
                                             GithubMessage.job_id) \
-                                     .filter(GithubMessage.user_id.notin_(existing),
+                                     .filter(is_new(GithubMessage.user_id),
                                              GithubMessage.job == self) \
                                      .distinct()
         from_relations = GithubRelation.query(GithubRelation.from_node_id.label('id'),
                                               GithubRelation.job_id) \
-                                       .filter(GithubRelation.from_node_id.notin_(existing),
+                                       .filter(is_new(GithubRelation.from_node_id),
                                                GithubRelation.job == self) \
                                        .distinct()
-        from_all = from_events.union(from_messages, from_relations)
+        return from_events.union(from_messages, from_relations)
 
+    def populate_users(self):
+        from_all = self.get_new_users_query()
         gu_table = self.metadata.tables[GithubUser.__tablename__]
         cols = ['id', 'job_id']
         insert_query = gu_table.insert().from_select(cols, from_all)
-        session = self.session_factory()
-        session.execute(insert_query)
-
-        trimmed_username = func.substr(GithubUser.username, 2, func.char_length(GithubUser.username) - 2)
-        GithubUser.filter(GithubUser.job == self, GithubUser.username.like('"%"')) \
-                  .update({'username': trimmed_username}, synchronize_session='fetch')
-        session.commit()
+        with self.session_scope() as session:
+            session.execute(insert_query)
 
     def _crawl_profiles(self, users):
         from community.platform.utils.search_utils import get_search, serialize_search_results
@@ -338,6 +339,14 @@ class GithubEvent(BaseEvent):
     owner
     """
 
+    PARTITION_BY_MONTH = True
+    # GithubJob._filter_by_date reads max(timestamp)
+    TIMESTAMP_INDEX_TYPE = 'btree'
+
     id = Column(BigInteger, primary_key=True, autoincrement=False)
     job_id = Column(Integer, ForeignKey('githubjob.id'), nullable=False)
     job = relationship('GithubJob')
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'job_id', 'timestamp')]
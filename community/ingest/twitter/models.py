@@ -1,14 +1,21 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 import itertools
 import logging
 
-from sqlalchemy import Column, String, Text, func, BigInteger
-from sqlalchemy.sql import functions
+from sqlalchemy import Column, String, Text, BigInteger, Computed, DateTime, ForeignKey, Integer, UniqueConstraint, \
+    literal, select
+from sqlalchemy.dialects.postgresql import ARRAY, insert
+from sqlalchemy.sql import functions, exists
 from sqlalchemy_utils import ChoiceType
 from tqdm import tqdm
 
+from community.app import settings
 from community.ingest.base.models import BaseJob, BaseSource, BaseUser, BaseMessage, \
-    BaseRelation, BaseMessageReaction, BaseMessageThread
+    BaseRelation, BaseMessageReaction, BaseMessageThread, BaseEvent, make_index
+from community.models import Base
+from community.platform.utils.iter_utils import chunkify
 
 _LOG = logging.getLogger(__name__)
 
@@ -19,22 +26,26 @@ class TwitterHandle(BaseSource):
     id = Column(BigInteger, primary_key=True, autoincrement=False)
     handle = Column(Text, nullable=False)
 
-    def crawl_messages(self):
-        session = self.session_factory()
+    def get_since_query(self):
+        return Tweet.query(functions.max(Tweet.timestamp)) \
+                    .select_from(Tweet) \
+                    .join(TweetJob, TweetJob.tweet_id == Tweet.id) \
+                    .join(TwitterJob, TwitterJob.id == TweetJob.job_id) \
+                    .filter(TwitterJob.query == self.handle,
+                            TwitterJob.crawl_type == TwitterJob.CRAWL_TYPE_HANDLE_MESSAGES)
+
+    def crawl_messages(self, process=True):
         try:
-            since = session.query(Tweet)\
-                           .join(TwitterJob, TwitterJob.id == Tweet.job_id) \
-                           .filter(TwitterJob.query == self.handle,
-                                   TwitterJob.crawl_type == TwitterJob.CRAWL_TYPE_HANDLE_MESSAGES) \
-                           .with_entities(functions.max(Tweet.timestamp)).one()[0]
+            since = self.get_since_query().one()[0]
         except IndexError:
             config = {}
         else:
             config = {'since': since}
-        TwitterJob.add_job(project_id=self.project_id,
-                           query=self.handle,
-                           crawl_type=TwitterJob.CRAWL_TYPE_HANDLE_MESSAGES,
-                           config=config)
+        return TwitterJob.add_job(project_id=self.project_id,
+                                  query=self.handle,
+                                  crawl_type=TwitterJob.CRAWL_TYPE_HANDLE_MESSAGES,
+                                  config=config,
+                                  process=process)
 
 
 class TwitterJob(BaseJob):
@@ -44,6 +55,8 @@ class TwitterJob(BaseJob):
         (CRAWL_TYPE_HANDLE_MESSAGES, CRAWL_TYPE_HANDLE_MESSAGES.title()),
         (CRAWL_TYPE_HASHTAG, CRAWL_TYPE_HASHTAG.title()),
     )
+    CRAWL_BACKEND_TWINT = 'twint'
+    CRAWL_BACKEND_API = 'api'
     BULK_CREATE_CHUNK_SIZE = 100
 
     query = Column(Text, nullable=False)
@@ -52,6 +65,10 @@ class TwitterJob(BaseJob):
     def __repr__(self):
         return '<%s:%s:%s:%s - %s>' % (self.__class__.__name__, self.project.name, self.query, self.config, self.status)
 
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'query', 'crawl_type')]
+
     @classmethod
     def add_job(cls, project_id, **kwargs):
         config = kwargs.get('config', {})
@@ -59,7 +76,7 @@ class TwitterJob(BaseJob):
             config['since'] = config['since'].strftime('%Y-%m-%d')
         if config.get('until'):
             config['until'] = config['until'].strftime('%Y-%m-%d')
-        super(cls, cls).add_job(project_id=project_id, **kwargs)
+        return super(cls, cls).add_job(project_id=project_id, **kwargs)
 
     @property
     def cleaned_config(self):
@@ -70,90 +87,277 @@ class TwitterJob(BaseJob):
         defaults.update(self.config)
         return defaults
 
-    def _process(self):
+    @classmethod
+    def process_together(cls, jobs):
+        # the twint stage is planned over all the jobs so that queries they
+        # share are scraped once. the other stages run job by job
+        from community.ingest.twitter.utils.twint_utils import run_crawls
+
+        with_tweets = settings.TWITTER_CRAWL_BACKEND != cls.CRAWL_BACKEND_TWINT
+        failed = {}
+        if not with_tweets:
+            for job in jobs:
+                with job.saving():
+                    job.status = job.STATUS_RUNNING
+            # a failed query only fails the jobs that share it
+            failed = run_crawls(jobs)
+        for job in jobs:
+            if job.id in failed:
+                query, ex = failed[job.id]
+                _LOG.error('%s: crawl failed for query:[%s] - %s', job, query, ex)
+                with job.saving():
+                    job.status = job.STATUS_ERROR
+            else:
+                job.process(with_tweets=with_tweets)
+
+    def _process(self, with_tweets=True):
         if self.crawl_type == self.CRAWL_TYPE_HANDLE_MESSAGES:
-            self.crawl_tweets_with_twint()
-            # self.crawl_tweets_with_api()
+            if with_tweets:
+                self.crawl_tweets()
             self.populate_threads()
             self.crawl_reactions()
             self.crawl_relations()
             self.populate_users()
             self.crawl_profiles()
         elif self.crawl_type == self.CRAWL_TYPE_HASHTAG:
-            self.crawl_tweets_with_twint()
-            # self.crawl_tweets_with_api()
+            if with_tweets:
+                self.crawl_tweets()
             self.populate_threads()
             self.populate_users()
             self.crawl_profiles()
         else:
             raise ValueError('unsupported crawl_type:%s' % self.crawl_type)
 
-    def crawl_tweets_with_twint(self):
+    def crawl_tweets(self):
+        if settings.TWITTER_CRAWL_BACKEND == self.CRAWL_BACKEND_TWINT:
+            self.crawl_tweets_with_twint()
+        elif settings.TWITTER_CRAWL_BACKEND == self.CRAWL_BACKEND_API:
+            self.crawl_tweets_with_api()
+        else:
+            raise ValueError('unsupported crawl backend:%s' % settings.TWITTER_CRAWL_BACKEND)
+
+    def get_twint_crawl_types(self):
         from community.ingest.twitter.utils.twint_utils import CrawlBuffer
 
         if self.crawl_type == self.CRAWL_TYPE_HANDLE_MESSAGES:
-            crawl_types = CrawlBuffer.HANDLE_CRAWL_TYPES
+            return CrawlBuffer.HANDLE_CRAWL_TYPES
         elif self.crawl_type == self.CRAWL_TYPE_HASHTAG:
-            crawl_types = CrawlBuffer.CRAWL_TYPE_HASHTAG
+            return (CrawlBuffer.CRAWL_TYPE_HASHTAG,)
         else:
             raise ValueError('unsupported crawl_type:%s' % self.crawl_type)
 
-        for crawl_type in crawl_types:
-            crawl_buffer = CrawlBuffer(self, crawl_type, **self.cleaned_config)
-            crawl_buffer.start_crawl()
+    def crawl_tweets_with_twint(self):
+        from community.ingest.twitter.utils.twint_utils import run_crawls
+
+        failed = run_crawls([self])
+        if failed:
+            query, ex = failed[self.id]
+            raise ex
+
+    def get_api_crawls(self):
+        from community.ingest.twitter.utils.api_utils import CLIENT
+
+        config = self.cleaned_config
+        params = {}
+        if config['since']:
+            params['start_time'] = '%sT00:00:00Z' % config['since']
+        if config['until']:
+            params['end_time'] = '%sT00:00:00Z' % config['until']
+
+        if self.crawl_type == self.CRAWL_TYPE_HANDLE_MESSAGES:
+            handle = TwitterHandle.filter(TwitterHandle.handle == self.query).first()
+            user_id = handle.id if handle else CLIENT.get_user(username=self.query).data.id
+            return [('get_users_tweets', user_id, params), ('get_users_mentions', user_id, params)]
+        elif self.crawl_type == self.CRAWL_TYPE_HASHTAG:
+            # recent search only reaches back a week. older windows are left to twint
+            week_ago = (datetime.datetime.utcnow() - datetime.timedelta(days=6)).strftime('%Y-%m-%d')
+            if config['since'] and config['since'] < week_ago:
+                _LOG.warning('%s: since:[%s] is older than recent search allows', self, config['since'])
+                params.pop('start_time')
+            query = self.query if self.query.startswith('#') else '#%s' % self.query
+            return [('search_recent_tweets', query, params)]
+        else:
+            raise ValueError('unsupported crawl_type:%s' % self.crawl_type)
 
     def crawl_tweets_with_api(self):
-        pass
+        from community.ingest.twitter.utils.api_utils import iter_tweet_pages, parse_timestamp
+
+        for method_name, arg, params in self.get_api_crawls():
+            for tweets, users in iter_tweet_pages(method_name, arg, **params):
+                if not tweets:
+                    continue
+                now = datetime.datetime.now()
+                usernames = {d['id']: d['username'] for d in users}
+                Tweet.bulk_create([Tweet(
+                    id=int(d['id']),
+                    message=d['text'],
+                    timestamp=parse_timestamp(d['created_at']),
+                    user_id=int(d['author_id']),
+                    job_id=self.id,
+                    # username goes into data like the twint rows so that Tweet.username is filled
+                    data=dict(d, username=usernames.get(d['author_id'])),
+                ) for d in tweets])
+                TweetJob.link((int(d['id']), self.id) for d in tweets)
+                # profiles come fresh with every page, so crawl_profiles can skip them
+                TwitterUser.bulk_upsert([TwitterUser(
+                    id=int(d['id']),
+                    username=d['username'],
+                    name=d['name'],
+                    data=d,
+                    refreshed_at=now,
+                    job_id=self.id,
+                ) for d in users], update_columns=('username', 'name', 'refreshed_at'))
 
     def populate_threads(self):
         pass
 
-    def crawl_reactions(self):
-        from community.ingest.twitter.utils.api_utils import get_liking_users, object_to_dict
+    @staticmethod
+    def get_young_since():
+        return datetime.datetime.now() - datetime.timedelta(days=settings.TWITTER_REACTION_RECRAWL_MAX_AGE_DAYS)
+
+    def get_reaction_crawl_candidates(self):
+        from community.ingest.twitter.utils.api_utils import get_like_counts
+
+        # a tweet whose like count has not moved since the last crawl has the
+        # same liking users, unless it is recent enough for likes to be swapped
+        young_since = self.get_young_since()
+        tweets = Tweet.query(Tweet.id, Tweet.timestamp, Tweet.like_count) \
+                      .join(TweetJob, TweetJob.tweet_id == Tweet.id)\
+                      .filter(TweetJob.job_id == self.id)\
+                      .all()
+        stale = []
+        unliked = []
+        for chunk in chunkify(tweets, 100):
+            like_counts = get_like_counts([tweet_id for tweet_id, _, _ in chunk])
+            for tweet_id, timestamp, seen_count in chunk:
+                like_count = like_counts.get(tweet_id)
+                if like_count is None or (like_count == seen_count and timestamp < young_since):
+                    continue
+                if like_count == 0:
+                    unliked.append((tweet_id, timestamp, like_count))
+                else:
+                    stale.append((tweet_id, timestamp, like_count))
+        _LOG.info('%s: tweets:[%s] stale:[%s] unliked:[%s]', self, len(tweets), len(stale), len(unliked))
+        return stale, unliked
+
+    @staticmethod
+    def mark_reactions_crawled(tweets):
+        now = datetime.datetime.now()
+        Tweet.bulk_update([Tweet(id=tweet_id, timestamp=timestamp, like_count=like_count, reactions_crawled_at=now)
+                           for tweet_id, timestamp, like_count in tweets])
 
-        new = Tweet.query(Tweet.id, Tweet.timestamp) \
-                   .filter(Tweet.job == self)\
-                   .all()
+    def crawl_reactions(self):
+        stale, unliked = self.get_reaction_crawl_candidates()
+        if unliked:
+            self.mark_reactions_crawled(unliked)
+
+        # young tweets are re-crawled even when their count is unchanged, so
+        # they get a new cache key every day
+        young_since = self.get_young_since()
+        crawl_date = datetime.date.today().isoformat()
+        tweets = [(tweet_id, timestamp, like_count, crawl_date if timestamp >= young_since else None)
+                  for tweet_id, timestamp, like_count in stale]
+        asyncio.run(self.async_crawl_reactions(tweets))
+
+    async def async_crawl_reactions(self, tweets):
+        from community.ingest.twitter.utils.async_api_utils import iter_liking_users
+        from community.platform.utils.orm_utils import remove_session
+
+        def write(objs, crawled):
+            # the tweets are only marked once their reactions are in
+            if objs:
+                TwitterReaction.bulk_upsert(objs)
+            self.mark_reactions_crawled(crawled)
+
+        # the writes run on a single writer thread while the workers keep fetching
+        loop = asyncio.get_running_loop()
+        writer = ThreadPoolExecutor(max_workers=1)
         objs = []
-        for tweet_id, timestamp in tqdm(new):
-            data = get_liking_users(tweet_id)
-            for d in data:
-                objs.append(TwitterReaction(
-                    reaction=TwitterReaction.REACTION_TYPE_LIKE,
-                    timestamp=timestamp,
-                    job_id=self.id,
-                    user_id=d.id,
-                    data=d.data,
-                    message_id=tweet_id
-                ))
-                if len(objs) > self.BULK_CREATE_CHUNK_SIZE:
-                    TwitterReaction.bulk_upsert(objs)
-                    objs = []
-        if objs:
-            TwitterReaction.bulk_upsert(objs)
+        crawled = []
+        try:
+            with tqdm(total=len(tweets)) as progress:
+                async for tweet_id, timestamp, like_count, users in iter_liking_users(tweets):
+                    progress.update()
+                    crawled.append((tweet_id, timestamp, like_count))
+                    for d in users:
+                        objs.append(TwitterReaction(
+                            reaction=TwitterReaction.REACTION_TYPE_LIKE,
+                            timestamp=timestamp,
+                            job_id=self.id,
+                            user_id=d.id,
+                            data=d.data,
+                            message_id=tweet_id
+                        ))
+                    if len(objs) > self.BULK_CREATE_CHUNK_SIZE:
+                        await loop.run_in_executor(writer, write, objs, crawled)
+                        objs = []
+                        crawled = []
+            if crawled:
+                await loop.run_in_executor(writer, write, objs, crawled)
+        finally:
+            writer.submit(remove_session).result()
+            writer.shutdown()
 
     def crawl_relations(self):
-        from community.ingest.twitter.utils.api_utils import get_user_followers, get_user_friends, object_to_dict
-
-        users = TwitterHandle.query(TwitterHandle.id).all()
-        objs = []
-        for user_id in users:
-            user_id = user_id[0]
-            data = get_user_followers(user_id)
-            for d in data:
-                objs.append(TwitterRelation(
-                    from_node_id=d.id,
-                    relation_type=TwitterRelation.RELATION_TYPE_FOLLOWER,
-                    to_node_id=user_id,
-                    data=d.data,
-                    timestamp=datetime.datetime.now(),
-                    job_id=self.id,
-                ))
-                if len(objs) > self.BULK_CREATE_CHUNK_SIZE:
-                    TwitterRelation.bulk_upsert(objs)
-                    objs = []
+        from community.ingest.twitter.utils.api_utils import get_user_followers
+
+        handle = TwitterHandle.filter(TwitterHandle.handle == self.query).first()
+        if handle is None:
+            _LOG.warning('%s: no handle for:[%s]. skipping relations', self, self.query)
+            return
+
+        followers = {d.id: d for d in get_user_followers(handle.id)}
+        snapshot = TwitterFollowerSnapshot.filter(TwitterFollowerSnapshot.handle_id == handle.id).first()
+        now = datetime.datetime.now()
+        if snapshot is None:
+            # nothing to diff against, so the current followers carry no events
+            followed = set(followers)
+            unfollowed = set()
+            events = []
+            snapshot = TwitterFollowerSnapshot(handle_id=handle.id)
+        else:
+            previous = set(snapshot.follower_ids)
+            followed = set(followers) - previous
+            unfollowed = previous - set(followers)
+            events = [TwitterFollowerEvent(event=TwitterFollowerEvent.EVENT_FOLLOW,
+                                           handle_id=handle.id,
+                                           user_id=user_id,
+                                           data=followers[user_id].data,
+                                           timestamp=now)
+                      for user_id in followed]
+            events.extend(TwitterFollowerEvent(event=TwitterFollowerEvent.EVENT_UNFOLLOW,
+                                               handle_id=handle.id,
+                                               user_id=user_id,
+                                               data={},
+                                               timestamp=now)
+                          for user_id in unfollowed)
+
+        objs = [TwitterRelation(
+            from_node_id=user_id,
+            relation_type=TwitterRelation.RELATION_TYPE_FOLLOWER,
+            to_node_id=handle.id,
+            data=followers[user_id].data,
+            timestamp=now,
+            job_id=self.id,
+        ) for user_id in followed]
         if objs:
             TwitterRelation.bulk_upsert(objs)
+        if events:
+            TwitterFollowerEvent.bulk_create(events)
+
+        # the snapshot goes last so that a failed run diffs against the old one again
+        snapshot.follower_ids = sorted(followers)
+        snapshot.timestamp = now
+        with self.session_scope() as session:
+            if unfollowed:
+                session.query(TwitterRelation)\
+                       .filter(TwitterRelation.to_node_id == handle.id,
+                               TwitterRelation.relation_type == TwitterRelation.RELATION_TYPE_FOLLOWER,
+                               TwitterRelation.from_node_id.in_(unfollowed))\
+                       .delete(synchronize_session=False)
+            session.merge(snapshot)
+        _LOG.info('%s: followers:[%s] followed:[%s] unfollowed:[%s]',
+                  self, len(followers), len(followed), len(unfollowed))
 
         # objs = []
         # for user_id in users:
@@ -172,63 +376,62 @@ class TwitterJob(BaseJob):
         # if objs:
         #     TwitterRelation.bulk_upsert(objs)
 
-    def populate_users(self):
-        existing = TwitterUser.query(TwitterUser.id).distinct()
+    def get_new_users_query(self):
+        def is_new(user_id):
+            return ~exists().where(TwitterUser.id == user_id)
+
         from_messages = Tweet.query(Tweet.user_id.label('id'),
-                                    Tweet.data['username'].label('username'),
-                                    Tweet.job_id) \
-                             .filter(Tweet.user_id.notin_(existing),
-                                     Tweet.job == self) \
+                                    Tweet.username,
+                                    TweetJob.job_id) \
+                             .join(TweetJob, TweetJob.tweet_id == Tweet.id) \
+                             .filter(is_new(Tweet.user_id),
+                                     TweetJob.job_id == self.id) \
                              .distinct()
         from_reactions = TwitterReaction.query(TwitterReaction.user_id.label('id'),
-                                               TwitterReaction.data['username'].label('username'),
+                                               TwitterReaction.username,
                                                TwitterReaction.job_id) \
-                                        .filter(TwitterReaction.user_id.notin_(existing),
+                                        .filter(is_new(TwitterReaction.user_id),
                                                 TwitterReaction.job == self) \
                                         .distinct()
         from_relations = TwitterRelation.query(TwitterRelation.from_node_id.label('id'),
-                                               TwitterRelation.data['username'].label('username'),
+                                               TwitterRelation.username,
                                                TwitterRelation.job_id) \
-                                        .filter(TwitterRelation.from_node_id.notin_(existing),
+                                        .filter(is_new(TwitterRelation.from_node_id),
                                                 TwitterRelation.job == self) \
                                         .distinct()
-        from_all = from_messages.union(from_reactions, from_relations)
+        return from_messages.union(from_reactions, from_relations)
 
+    def populate_users(self):
+        from_all = self.get_new_users_query()
         cols = ['id', 'username', 'job_id']
         tu_table = self.metadata.tables[TwitterUser.__tablename__]
         insert_query = tu_table.insert().from_select(cols, from_all)
-        session = self.session_factory()
-        session.execute(insert_query)
-
-        trimmed_username = func.substr(TwitterUser.username, 2, func.char_length(TwitterUser.username) - 2)
-        TwitterUser.filter(TwitterUser.job == self, TwitterUser.username.like('"%"'))\
-                   .update({'username':  trimmed_username}, synchronize_session='fetch')
-        session.commit()
+        with self.session_scope() as session:
+            session.execute(insert_query)
 
     def crawl_profiles(self):
         from community.ingest.twitter.utils.api_utils import get_users
-        from community.platform.utils.iter_utils import chunkify
 
-        users = TwitterUser.query(TwitterUser.id)\
-                           .filter(TwitterUser.job == self)\
+        # stale users of every job are refreshed together so that each request
+        # carries a full batch of ids
+        users = TwitterUser.get_stale_query()\
+                           .order_by(TwitterUser.id)\
                            .all()
         users = list(itertools.chain.from_iterable(users))
-        objs = []
+        _LOG.info('%s: stale profiles:[%s]', self, len(users))
         for user_id_set in chunkify(users, 100):
-            user_id_set = ','.join(map(str, user_id_set))
-            data = get_users(user_id_set)
-            for d in data:
-                objs.append(TwitterUser(
-                    id=d['id'],
-                    username=d['username'],
-                    name=d['name'],
-                    data=d.data,
-                    job=self
-                ))
-                if len(objs) > self.BULK_CREATE_CHUNK_SIZE:
-                    TwitterUser.bulk_update(objs)
-                    objs = []
-        if objs:
+            data = get_users(','.join(map(str, user_id_set)))
+            now = datetime.datetime.now()
+            objs = [TwitterUser(
+                id=int(d['id']),
+                username=d['username'],
+                name=d['name'],
+                data=d,
+                refreshed_at=now
+            ) for d in data]
+            # suspended and deleted users are marked too, or they would be asked for on every run
+            missing = set(user_id_set) - {obj.id for obj in objs}
+            objs.extend(TwitterUser(id=user_id, refreshed_at=now) for user_id in missing)
             TwitterUser.bulk_update(objs)
 
 
@@ -239,6 +442,70 @@ class TwitterUser(BaseUser):
 class Tweet(BaseMessage):
     JOB_MODEL = TwitterJob
     USER_MODEL = TwitterUser
+    PARTITION_BY_MONTH = True
+
+    username = Column(Text, Computed("data ->> 'username'", persisted=True))
+    # like count as of the last reaction crawl
+    like_count = Column(Integer)
+    reactions_crawled_at = Column(DateTime)
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'job_id', 'user_id', 'username')]
+
+
+class TweetJob(Base):
+    # tweets are stored once. Tweet.job_id is the job that saw it first and
+    # this links it to every job (and project) that asked for it
+    tweet_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    job_id = Column(Integer, ForeignKey('twitterjob.id'), primary_key=True)
+    project_id = Column(Integer, ForeignKey('project.id'), nullable=False)
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'job_id', 'tweet_id'), make_index(cls, 'project_id')]
+
+    @classmethod
+    def get_backfill_query(cls):
+        # links for the tweets written before this table existed
+        select_query = select(Tweet.id, Tweet.job_id, TwitterJob.project_id)\
+            .join_from(Tweet, TwitterJob, TwitterJob.id == Tweet.job_id)
+        return insert(cls.__table__)\
+            .from_select(['tweet_id', 'job_id', 'project_id'], select_query)\
+            .on_conflict_do_nothing()
+
+    @classmethod
+    def link(cls, pairs, strategy=Base.BULK_STRATEGY_INSERT):
+        # pairs are (tweet_id, job_id). the project ids are looked up per job
+        pairs = list(pairs)
+        job_ids = {job_id for _, job_id in pairs}
+        if not job_ids:
+            return
+        project_ids = dict(TwitterJob.query(TwitterJob.id, TwitterJob.project_id)
+                                     .filter(TwitterJob.id.in_(job_ids))
+                                     .all())
+        rows = ({'tweet_id': tweet_id, 'job_id': job_id, 'project_id': project_ids[job_id]}
+                for tweet_id, job_id in pairs)
+        cls.bulk_create_rows(rows, strategy=strategy)
+
+    @classmethod
+    def copy_links(cls, from_job_ids, job_id, since=None, until=None):
+        # links the tweets already stored for other jobs of the same query to
+        # job_id, instead of crawling them again
+        project_id = TwitterJob.query(TwitterJob.project_id).filter(TwitterJob.id == job_id).scalar()
+        select_query = select(Tweet.id, literal(job_id), literal(project_id))\
+            .distinct()\
+            .join_from(Tweet, cls, cls.tweet_id == Tweet.id)\
+            .where(cls.job_id.in_(from_job_ids))
+        if since:
+            select_query = select_query.where(Tweet.timestamp >= since)
+        if until:
+            select_query = select_query.where(Tweet.timestamp < until)
+        insert_query = insert(cls.__table__)\
+            .from_select(['tweet_id', 'job_id', 'project_id'], select_query)\
+            .on_conflict_do_nothing()
+        with cls.session_scope() as session:
+            return session.execute(insert_query).rowcount
 
 
 class TwitterRelation(BaseRelation):
@@ -250,6 +517,35 @@ class TwitterRelation(BaseRelation):
         (RELATION_TYPE_FRIEND, RELATION_TYPE_FRIEND.title()),
         (RELATION_TYPE_FOLLOWER, RELATION_TYPE_FOLLOWER.title())
     )
+    UPSERT_CONFLICT_COLUMNS = ('from_node_id', 'to_node_id', 'relation_type')
+
+    username = Column(Text, Computed("data ->> 'username'", persisted=True))
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [
+            UniqueConstraint(*cls.UPSERT_CONFLICT_COLUMNS),
+            make_index(cls, 'job_id', 'from_node_id', 'username'),
+        ]
+
+
+class TwitterFollowerSnapshot(Base):
+    # the current follower ids of a handle, diffed by crawl_relations
+    handle_id = Column(BigInteger, primary_key=True, autoincrement=False)
+    follower_ids = Column(ARRAY(BigInteger), nullable=False)
+    timestamp = Column(DateTime, nullable=False)
+
+
+class TwitterFollowerEvent(BaseEvent):
+    EVENT_FOLLOW = 'follow'
+    EVENT_UNFOLLOW = 'unfollow'
+
+    id = Column(BigInteger, primary_key=True)
+    handle_id = Column(BigInteger, nullable=False)
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [make_index(cls, 'handle_id', 'timestamp')]
 
 
 class TwitterReaction(BaseMessageReaction):
@@ -261,6 +557,16 @@ class TwitterReaction(BaseMessageReaction):
     REACTION_TYPES = (
         (REACTION_TYPE_LIKE, REACTION_TYPE_LIKE.title())
     )
+    UPSERT_CONFLICT_COLUMNS = ('message_id', 'user_id', 'reaction')
+
+    username = Column(Text, Computed("data ->> 'username'", persisted=True))
+
+    @classmethod
+    def get_table_args(cls):
+        return super().get_table_args() + [
+            UniqueConstraint(*cls.UPSERT_CONFLICT_COLUMNS),
+            make_index(cls, 'job_id', 'user_id', 'username'),
+        ]
 
 
 class TwitterThread(BaseMessageThread):
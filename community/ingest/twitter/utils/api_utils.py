@@ -1,4 +1,11 @@
-from retry import retry
+import datetime
+from functools import partial
+import itertools
+import logging
+import re
+import threading
+import time
+
 import tweepy
 
 from rainman import cache, paginated_cache
@@ -6,14 +13,228 @@ from tweepy import TooManyRequests
 
 from community.app import settings
 
-AUTH = tweepy.OAuthHandler(settings.TWITTER_API_KEY, settings.TWITTER_SECRET_KEY)
-AUTH.set_access_token(settings.TWITTER_ACCESS_TOKEN, settings.TWITTER_ACCESS_TOKEN_SECRET)
-API = tweepy.API(AUTH)
-CLIENT = tweepy.Client(consumer_key=settings.TWITTER_API_KEY,
-                       consumer_secret=settings.TWITTER_SECRET_KEY,
-                       access_token=settings.TWITTER_ACCESS_TOKEN,
-                       access_token_secret=settings.TWITTER_ACCESS_TOKEN_SECRET,
-                       bearer_token=settings.TWITTER_BEARER_TOKEN)
+_LOG = logging.getLogger(__name__)
+
+
+class LocalRateLimiter(object):
+    # budgets of the current process only
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.budgets = {}
+
+    def acquire(self, key, now):
+        # reserves a request and returns 0, or returns how many seconds are
+        # left until the endpoint's window resets
+        with self.lock:
+            remaining, reset = self.budgets.get(key, (None, None))
+            if remaining is None or reset <= now:
+                return 0
+            if remaining > 0:
+                self.budgets[key] = (remaining - 1, reset)
+                return 0
+            return reset - now
+
+    def set_budget(self, key, remaining, reset):
+        with self.lock:
+            self.budgets[key] = (remaining, reset)
+
+    def get_remaining(self, key, now):
+        # None when the budget is not known yet or its window has reset
+        with self.lock:
+            remaining, reset = self.budgets.get(key, (None, None))
+        if remaining is None or reset <= now:
+            return None
+        return remaining
+
+
+class RedisRateLimiter(object):
+    # budgets shared by every process crawling with the same credentials
+    PREFIX = 'twitter:rate_limit:'
+    ACQUIRE_SCRIPT = """
+local remaining = tonumber(redis.call('HGET', KEYS[1], 'remaining'))
+local reset = tonumber(redis.call('HGET', KEYS[1], 'reset'))
+local now = tonumber(ARGV[1])
+if remaining == nil or reset == nil or reset <= now then
+    return 0
+end
+if remaining > 0 then
+    redis.call('HINCRBY', KEYS[1], 'remaining', -1)
+    return 0
+end
+return reset - now
+"""
+
+    def __init__(self):
+        import redis
+
+        self.redis = redis.Redis(host=settings.REDIS_HOST, port=settings.REDIS_PORT, db=settings.REDIS_DB)
+        self.redis.ping()
+        self._acquire = self.redis.register_script(self.ACQUIRE_SCRIPT)
+
+    def acquire(self, key, now):
+        return int(self._acquire(keys=[self.PREFIX + key], args=[now]))
+
+    def set_budget(self, key, remaining, reset):
+        name = self.PREFIX + key
+        pipe = self.redis.pipeline()
+        pipe.hset(name, mapping={'remaining': remaining, 'reset': reset})
+        pipe.expireat(name, reset + 60)
+        pipe.execute()
+
+    def get_remaining(self, key, now):
+        remaining, reset = self.redis.hmget(self.PREFIX + key, 'remaining', 'reset')
+        if remaining is None or reset is None or int(reset) <= now:
+            return None
+        return int(remaining)
+
+
+RATE_LIMITER = None
+_RATE_LIMITER_LOCK = threading.Lock()
+# sleep this long after a 429 that came without rate limit headers
+DEFAULT_RATE_LIMIT_WINDOW = 15 * 60
+
+
+def get_rate_limiter():
+    global RATE_LIMITER
+
+    if RATE_LIMITER is None:
+        with _RATE_LIMITER_LOCK:
+            if RATE_LIMITER is None:
+                if settings.TWITTER_RATE_LIMIT_BACKEND == 'redis':
+                    try:
+                        RATE_LIMITER = RedisRateLimiter()
+                    except Exception as ex:
+                        _LOG.warning('redis unavailable. rate limits are tracked per process - %s', ex)
+                        RATE_LIMITER = LocalRateLimiter()
+                else:
+                    RATE_LIMITER = LocalRateLimiter()
+    return RATE_LIMITER
+
+
+def get_endpoint_key(method, route, user_auth):
+    # limits are per endpoint, not per object. /2/tweets/1/liking_users and
+    # /2/tweets/2/liking_users share a budget
+    route = re.sub(r'(?<=.)/\d+(?=/|$)', '/:id', route)
+    return '%s:%s:%s' % ('user' if user_auth else 'app', method, route)
+
+
+class CredentialExhausted(Exception):
+    def __init__(self, key, wait):
+        super().__init__('%s is exhausted for %ss' % (key, wait))
+        self.key = key
+        self.wait = wait
+
+
+class RateLimitedClient(tweepy.Client):
+    # waits for the endpoint's budget before each request and updates it
+    # from the x-rate-limit-* headers of each response. with block=False it
+    # raises CredentialExhausted instead of sleeping so that a ClientPool can
+    # move on to another credential
+    def __init__(self, *args, name='default', block=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.name = name
+        self.block = block
+
+    def wait_for_budget(self, key):
+        rate_limiter = get_rate_limiter()
+        while True:
+            wait = rate_limiter.acquire(key, int(time.time()))
+            if wait <= 0:
+                return
+            if not self.block:
+                raise CredentialExhausted(key, wait)
+            _LOG.info('rate limit for %s exhausted. sleeping for %ss', key, wait + 1)
+            time.sleep(wait + 1)
+
+    def update_budget(self, key, headers, is_exhausted=False):
+        remaining = headers.get('x-rate-limit-remaining')
+        reset = headers.get('x-rate-limit-reset')
+        if reset is None:
+            if not is_exhausted:
+                return
+            remaining, reset = 0, int(time.time()) + DEFAULT_RATE_LIMIT_WINDOW
+        get_rate_limiter().set_budget(key, 0 if is_exhausted else int(remaining), int(reset))
+
+    def get_key(self, method, route, user_auth=False):
+        return '%s:%s' % (self.name, get_endpoint_key(method, route, user_auth))
+
+    def request(self, method, route, params=None, json=None, user_auth=False):
+        key = self.get_key(method, route, user_auth)
+        while True:
+            self.wait_for_budget(key)
+            try:
+                response = super().request(method, route, params=params, json=json, user_auth=user_auth)
+            except TooManyRequests as ex:
+                self.update_budget(key, ex.response.headers, is_exhausted=True)
+                continue
+            self.update_budget(key, response.headers)
+            return response
+
+
+class ClientPool(object):
+    # stands in for a tweepy.Client. calls rotate over the credentials and
+    # skip the ones whose budget for the endpoint is spent. when all of them
+    # are, it sleeps until the earliest reset
+    def __init__(self, clients):
+        self.clients = clients
+        self._offsets = itertools.count()
+
+    @classmethod
+    def from_credentials(cls, credentials):
+        clients = [RateLimitedClient(name=c['name'],
+                                     block=False,
+                                     consumer_key=c['api_key'],
+                                     consumer_secret=c['secret_key'],
+                                     access_token=c['access_token'],
+                                     access_token_secret=c['access_token_secret'],
+                                     bearer_token=c['bearer_token'])
+                   for c in credentials]
+        return cls(clients)
+
+    def rotate(self, fn):
+        while True:
+            offset = next(self._offsets)
+            waits = []
+            for i in range(len(self.clients)):
+                client = self.clients[(offset + i) % len(self.clients)]
+                try:
+                    return fn(client)
+                except CredentialExhausted as ex:
+                    waits.append(ex.wait)
+            wait = min(waits)
+            _LOG.info('all %s credentials are exhausted. sleeping for %ss', len(self.clients), wait + 1)
+            time.sleep(wait + 1)
+
+    def call(self, method_name, *args, **kwargs):
+        return self.rotate(lambda client: getattr(client, method_name)(*args, **kwargs))
+
+    def get_remaining(self, method, route, user_auth=False):
+        # calls left in the current window over all the credentials. None
+        # when any of them has no known budget for the endpoint yet
+        rate_limiter = get_rate_limiter()
+        now = int(time.time())
+        total = 0
+        for client in self.clients:
+            remaining = rate_limiter.get_remaining(client.get_key(method, route, user_auth), now)
+            if remaining is None:
+                return None
+            total += remaining
+        return total
+
+    def __getattr__(self, name):
+        attr = getattr(self.clients[0], name)
+        if not callable(attr):
+            return attr
+        return partial(self.call, name)
+
+
+# the v1 api is only used for friends lists and sticks to the first
+# credential, sleeping through its rate limits
+AUTH = tweepy.OAuthHandler(settings.TWITTER_CREDENTIALS[0]['api_key'], settings.TWITTER_CREDENTIALS[0]['secret_key'])
+AUTH.set_access_token(settings.TWITTER_CREDENTIALS[0]['access_token'],
+                      settings.TWITTER_CREDENTIALS[0]['access_token_secret'])
+API = tweepy.API(AUTH, wait_on_rate_limit=True)
+CLIENT = ClientPool.from_credentials(settings.TWITTER_CREDENTIALS)
 MEDIA_FIELDS = [
     'duration_ms',
     'height',
@@ -59,6 +280,10 @@ TWEET_FIELDS = [
     'text',
     'withheld'
 ]
+
+# the metrics that are not public need user auth and break app only requests
+PUBLIC_TWEET_FIELDS = [f for f in TWEET_FIELDS if f not in ('non_public_metrics', 'organic_metrics', 'promoted_metrics')]
+
 USER_FIELDS = [
     'created_at',
     'description',
@@ -103,30 +328,73 @@ def get_user_mentions(user_id, pagination_token=None):
     return value, next_token
 
 
-@paginated_cache(to_python=to_users)
-def get_user_followers(user_id, pagination_token=None):
-    resp = CLIENT.get_users_followers(user_id,
-                                      max_results=1000,
-                                      pagination_token=pagination_token,
-                                      user_fields=USER_FIELDS)
-    next_token = resp.meta.get('next_token')
-    value = [obj.data for obj in resp.data]
-    return value, next_token
+def parse_timestamp(s):
+    return datetime.datetime.strptime(s[:19], '%Y-%m-%dT%H:%M:%S')
+
+
+def iter_tweet_pages(method_name, *args, **kwargs):
+    # yields (tweets, users) per page. the authors come along through the
+    # author_id expansion so that no separate profile lookup is needed.
+    # not cached, every crawl asks for what is new since the last one
+    token_param = 'next_token' if method_name == 'search_recent_tweets' else 'pagination_token'
+    token = None
+    while True:
+        if token:
+            kwargs[token_param] = token
+        resp = CLIENT.call(method_name, *args,
+                           max_results=100,
+                           expansions=['author_id'],
+                           tweet_fields=PUBLIC_TWEET_FIELDS,
+                           user_fields=USER_FIELDS,
+                           **kwargs)
+        users = (resp.includes or {}).get('users', [])
+        yield [obj.data for obj in resp.data or []], [obj.data for obj in users]
+        token = resp.meta.get('next_token')
+        if not token:
+            break
+
+
+def get_user_followers(user_id):
+    # not cached, every crawl diffs the current followers against the last
+    # snapshot. caching whole follower lists per crawl only grew the cache
+    users = []
+    pagination_token = None
+    while True:
+        resp = CLIENT.get_users_followers(user_id,
+                                          max_results=1000,
+                                          pagination_token=pagination_token,
+                                          user_fields=USER_FIELDS)
+        users.extend(resp.data or [])
+        pagination_token = resp.meta.get('next_token')
+        if not pagination_token:
+            return users
 
 
-@cache(to_python=to_users)
 def get_users(id_set):
+    # not cached, crawl_profiles only asks for stale profiles. unknown and
+    # suspended ids are missing from the result
     resp = CLIENT.get_users(ids=id_set, user_fields=USER_FIELDS)
-    value = [obj.data for obj in resp.data]
+    value = [obj.data for obj in resp.data or []]
     return value
 
 
+def get_like_counts(tweet_ids):
+    # not cached, the counts are what tells us whether the cache is stale.
+    # deleted and protected tweets are missing from the result
+    resp = CLIENT.get_tweets(ids=tweet_ids, tweet_fields=['public_metrics'])
+    return {obj.id: obj.public_metrics['like_count'] for obj in resp.data or []}
+
+
+LIKING_USERS_ROUTE = '/2/tweets/%s/liking_users'
+
+
 @cache(to_python=to_users)
-@retry(TooManyRequests, tries=1000, delay=30)
-def get_liking_users(tweet_id):
+def get_liking_users(tweet_id, like_count=None, crawl_key=None):
+    # like_count and crawl_key are only part of the cache key. a tweet with
+    # new likes or a new crawl_key misses the cache
     from tweepy import User
 
-    route = '/2/tweets/%s/liking_users' % tweet_id
+    route = LIKING_USERS_ROUTE % tweet_id
     resp = CLIENT._make_request(
         method="GET",
         route=route,
@@ -0,0 +1,57 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+from community.app import settings
+from community.ingest.twitter.utils.api_utils import CLIENT, LIKING_USERS_ROUTE, get_liking_users
+
+_LOG = logging.getLogger(__name__)
+
+
+def get_liking_users_concurrency(max_concurrency=None):
+    # no more workers than the credentials have calls left in this window.
+    # before the first response the budget is unknown and each credential
+    # gets one worker
+    if max_concurrency is None:
+        max_concurrency = settings.TWITTER_REACTION_CRAWL_CONCURRENCY
+    remaining = CLIENT.get_remaining('GET', LIKING_USERS_ROUTE % 0)
+    if remaining is None:
+        remaining = len(CLIENT.clients)
+    return max(1, min(max_concurrency, remaining))
+
+
+async def iter_liking_users(tweets, concurrency=None):
+    # tweets are (tweet_id, timestamp, like_count, crawl_key). yields
+    # (tweet_id, timestamp, like_count, users) as they come in. the lookups
+    # go through the cached get_liking_users on `concurrency` threads and
+    # the queue is bounded so that a slow consumer holds the workers back
+    if concurrency is None:
+        concurrency = get_liking_users_concurrency()
+    _LOG.info('crawling liking users with %s workers', concurrency)
+    loop = asyncio.get_running_loop()
+    tweets = iter(tweets)
+    queue = asyncio.Queue(maxsize=concurrency * 2)
+
+    async def worker(executor):
+        try:
+            for tweet_id, timestamp, like_count, crawl_key in tweets:
+                users = await loop.run_in_executor(executor, get_liking_users, tweet_id, like_count, crawl_key)
+                await queue.put((tweet_id, timestamp, like_count, users))
+        finally:
+            await queue.put(None)
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        workers = [asyncio.create_task(worker(executor)) for _ in range(concurrency)]
+        try:
+            running = len(workers)
+            while running:
+                item = await queue.get()
+                if item is None:
+                    running -= 1
+                else:
+                    yield item
+            # re-raises the first worker error
+            await asyncio.gather(*workers)
+        finally:
+            for w in workers:
+                w.cancel()
@@ -0,0 +1,120 @@
+import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+from community.ingest.twitter.utils.stream_utils import RULES_ROUTE, STREAM_ROUTE
+
+_LOG = logging.getLogger(__name__)
+
+
+class MockStreamState(object):
+    # rules and ids shared by the handler threads
+    def __init__(self, interval, seed=None):
+        self.interval = interval
+        self.rules = {}
+        self.lock = threading.Lock()
+        self.rule_ids = itertools.count(1)
+        self.tweet_ids = itertools.count(int(time.time() * 1000) << 22)
+        self.random = random.Random(seed)
+
+    def get_terms(self):
+        with self.lock:
+            rules = list(self.rules.values())
+        return [term for rule in rules for term in rule.split(' OR ')]
+
+    def make_payload(self, term):
+        tweet_id = str(next(self.tweet_ids))
+        author_id = str(self.random.randint(1, 10 ** 9))
+        username = 'user%s' % author_id
+        entities = {}
+        text = 'mock tweet %s' % tweet_id
+        if term.startswith('from:'):
+            username = term[len('from:'):]
+        elif term.startswith('@'):
+            entities['mentions'] = [{'start': 0, 'end': len(term), 'username': term[1:]}]
+            text = '%s %s' % (term, text)
+        elif term.startswith('#'):
+            entities['hashtags'] = [{'start': len(text) + 1, 'end': len(text) + 1 + len(term), 'tag': term[1:]}]
+            text = '%s %s' % (text, term)
+        tweet = {
+            'id': tweet_id,
+            'text': text,
+            'author_id': author_id,
+            'created_at': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+            'entities': entities,
+            'public_metrics': {'retweet_count': 0, 'reply_count': 0, 'like_count': 0, 'quote_count': 0},
+        }
+        user = {'id': author_id, 'username': username, 'name': username}
+        return {'data': tweet, 'includes': {'users': [user]}, 'matching_rules': []}
+
+
+class MockStreamHandler(BaseHTTPRequestHandler):
+    state = None
+
+    def log_message(self, format, *args):
+        _LOG.debug(format, *args)
+
+    def send_json(self, d, status=200):
+        body = json.dumps(d).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == RULES_ROUTE:
+            with self.state.lock:
+                rules = [{'id': rule_id, 'value': value} for rule_id, value in self.state.rules.items()]
+            self.send_json({'data': rules, 'meta': {'result_count': len(rules)}})
+        elif path == STREAM_ROUTE:
+            self.stream()
+        else:
+            self.send_json({'title': 'Not Found'}, status=404)
+
+    def do_POST(self):
+        if urlparse(self.path).path != RULES_ROUTE:
+            self.send_json({'title': 'Not Found'}, status=404)
+            return
+        d = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        with self.state.lock:
+            for rule_id in d.get('delete', {}).get('ids', []):
+                self.state.rules.pop(rule_id, None)
+            added = []
+            for rule in d.get('add', []):
+                rule_id = str(next(self.state.rule_ids))
+                self.state.rules[rule_id] = rule['value']
+                added.append({'id': rule_id, 'value': rule['value']})
+        self.send_json({'data': added, 'meta': {'summary': {'created': len(added)}}})
+
+    def stream(self):
+        # the connection is closed rather than chunked, which is enough for iter_lines
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.end_headers()
+        try:
+            while True:
+                terms = self.state.get_terms()
+                if terms:
+                    payload = self.state.make_payload(self.state.random.choice(terms))
+                    self.wfile.write(json.dumps(payload).encode() + b'\r\n')
+                else:
+                    self.wfile.write(b'\r\n')
+                self.wfile.flush()
+                time.sleep(self.state.interval)
+        except (BrokenPipeError, ConnectionResetError):
+            _LOG.info('stream client disconnected')
+
+
+def run(host='127.0.0.1', port=8089, interval=1.0):
+    handler = type('Handler', (MockStreamHandler,), {'state': MockStreamState(interval)})
+    server = ThreadingHTTPServer((host, port), handler)
+    _LOG.info('serving a mock twitter stream on http://%s:%s', host, port)
+    server.serve_forever()
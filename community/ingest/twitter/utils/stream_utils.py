@@ -0,0 +1,255 @@
+import json
+import logging
+import os
+import signal
+import time
+
+import psutil
+import requests
+
+from community.app import settings
+from community.ingest.twitter.utils.api_utils import PUBLIC_TWEET_FIELDS, USER_FIELDS, parse_timestamp
+
+_LOG = logging.getLogger(__name__)
+
+RULES_ROUTE = '/2/tweets/search/stream/rules'
+STREAM_ROUTE = '/2/tweets/search/stream'
+MAX_RULE_LENGTH = 512
+
+
+def pack_rules(terms, max_length=MAX_RULE_LENGTH):
+    # the number of rules is capped much lower than their length, so terms
+    # are OR-ed together into as few rules as fit
+    rules = []
+    current = ''
+    for term in sorted(terms):
+        candidate = '%s OR %s' % (current, term) if current else term
+        if current and len(candidate) > max_length:
+            rules.append(current)
+            current = term
+        else:
+            current = candidate
+    if current:
+        rules.append(current)
+    return rules
+
+
+class JobMatcher(object):
+    # packed rules don't say which term matched, so tweets are linked to the
+    # latest job of every handle and hashtag they mention
+    def __init__(self, handle_jobs, hashtag_jobs):
+        self.handle_jobs = handle_jobs
+        self.hashtag_jobs = hashtag_jobs
+
+    @classmethod
+    def from_db(cls):
+        from sqlalchemy.sql import functions
+        from community.ingest.twitter.models import TwitterHandle, TwitterJob
+
+        latest = TwitterJob.query(TwitterJob.query, TwitterJob.crawl_type, functions.max(TwitterJob.id))\
+                           .group_by(TwitterJob.query, TwitterJob.crawl_type)\
+                           .all()
+        jobs = {(query.lower().lstrip('#'), crawl_type.code): job_id for query, crawl_type, job_id in latest}
+        handle_jobs = {}
+        for (handle,) in TwitterHandle.query(TwitterHandle.handle).all():
+            job_id = jobs.get((handle.lower(), TwitterJob.CRAWL_TYPE_HANDLE_MESSAGES))
+            if job_id is None:
+                _LOG.warning('no job for handle:[%s]. not streaming it', handle)
+            else:
+                handle_jobs[handle.lower()] = job_id
+        hashtag_jobs = {query: job_id for (query, crawl_type), job_id in jobs.items()
+                        if crawl_type == TwitterJob.CRAWL_TYPE_HASHTAG}
+        return cls(handle_jobs, hashtag_jobs)
+
+    def get_terms(self):
+        terms = []
+        for handle in self.handle_jobs:
+            terms.extend(['from:%s' % handle, '@%s' % handle])
+        terms.extend('#%s' % hashtag for hashtag in self.hashtag_jobs)
+        return terms
+
+    def get_job_ids(self, tweet, username):
+        entities = tweet.get('entities') or {}
+        handles = {username} | {d['username'] for d in entities.get('mentions', [])}
+        job_ids = [self.handle_jobs[handle.lower()] for handle in handles
+                   if handle and handle.lower() in self.handle_jobs]
+        job_ids.extend(self.hashtag_jobs[d['tag'].lower()] for d in entities.get('hashtags', [])
+                       if d['tag'].lower() in self.hashtag_jobs)
+        return sorted(set(job_ids))
+
+
+class StreamClient(object):
+    PID_FILE = settings.PID_DIR + 'twitter_listener/current.pid'
+    # twitter sends a keep-alive newline every 20s. silence for longer means the connection is gone
+    READ_TIMEOUT = 90
+    MIN_BACKOFF = 1
+    MIN_RATE_LIMIT_BACKOFF = 60
+    MAX_BACKOFF = 320
+
+    def __init__(self, base_url=None, bearer_token=None, batch_size=None, flush_interval=None):
+        self.base_url = base_url or settings.TWITTER_API_BASE_URL
+        self.batch_size = batch_size or settings.TWITTER_STREAM_BATCH_SIZE
+        self.flush_interval = flush_interval or settings.TWITTER_STREAM_FLUSH_INTERVAL
+        self.session = requests.Session()
+        bearer_token = bearer_token or settings.TWITTER_CREDENTIALS[0]['bearer_token']
+        self.session.headers['Authorization'] = 'Bearer %s' % bearer_token
+        self.matcher = None
+        self.rules_synced_at = 0
+        self.objs = []
+        self.links = []
+        self.first_buffered_at = None
+
+    def get_url(self, route):
+        return self.base_url.rstrip('/') + route
+
+    def get_rules(self):
+        resp = self.session.get(self.get_url(RULES_ROUTE))
+        resp.raise_for_status()
+        return resp.json().get('data') or []
+
+    def sync_rules(self):
+        # rule changes apply to the open connection, no reconnect needed
+        self.matcher = JobMatcher.from_db()
+        rules = pack_rules(self.matcher.get_terms())
+        existing = {d['value']: d['id'] for d in self.get_rules()}
+        stale = [rule_id for value, rule_id in existing.items() if value not in rules]
+        new = [value for value in rules if value not in existing]
+        if stale:
+            resp = self.session.post(self.get_url(RULES_ROUTE), json={'delete': {'ids': stale}})
+            resp.raise_for_status()
+        if new:
+            resp = self.session.post(self.get_url(RULES_ROUTE), json={'add': [{'value': value} for value in new]})
+            resp.raise_for_status()
+        self.rules_synced_at = time.time()
+        _LOG.info('stream rules:[%s] added:[%s] deleted:[%s]', len(rules), len(new), len(stale))
+
+    def iter_payloads(self):
+        # yields None for keep-alives so that the caller gets to flush on a quiet stream
+        params = {
+            'tweet.fields': ','.join(PUBLIC_TWEET_FIELDS),
+            'expansions': 'author_id',
+            'user.fields': ','.join(USER_FIELDS),
+        }
+        with self.session.get(self.get_url(STREAM_ROUTE), params=params, stream=True,
+                              timeout=(10, self.READ_TIMEOUT)) as resp:
+            resp.raise_for_status()
+            _LOG.info('connected to stream')
+            for line in resp.iter_lines():
+                yield json.loads(line) if line else None
+
+    def append(self, payload):
+        from community.ingest.twitter.models import Tweet
+
+        tweet = payload.get('data')
+        if not tweet:
+            _LOG.warning('stream error:[%s]', payload)
+            return
+        users = {d['id']: d for d in payload.get('includes', {}).get('users', [])}
+        username = users.get(tweet['author_id'], {}).get('username')
+        job_ids = self.matcher.get_job_ids(tweet, username)
+        if not job_ids:
+            _LOG.debug('no job for tweet:[%s]', tweet['id'])
+            return
+
+        # username goes into data like the twint rows so that Tweet.username is filled
+        data = dict(tweet, username=username)
+        self.objs.append(Tweet(
+            id=int(tweet['id']),
+            message=tweet['text'],
+            timestamp=parse_timestamp(tweet['created_at']),
+            user_id=int(tweet['author_id']),
+            job_id=job_ids[0],
+            data=data,
+        ))
+        self.links.extend((int(tweet['id']), job_id) for job_id in job_ids)
+        if self.first_buffered_at is None:
+            self.first_buffered_at = time.time()
+
+    def should_flush(self):
+        if not self.objs:
+            return False
+        return len(self.objs) >= self.batch_size or time.time() - self.first_buffered_at >= self.flush_interval
+
+    def flush(self):
+        from community.ingest.twitter.models import Tweet, TweetJob
+
+        if self.objs:
+            objs, self.objs, self.first_buffered_at = self.objs, [], None
+            links, self.links = self.links, []
+            Tweet.bulk_create(objs)
+            TweetJob.link(links)
+
+    def consume(self):
+        for payload in self.iter_payloads():
+            if payload:
+                self.append(payload)
+            if self.should_flush():
+                self.flush()
+            if time.time() - self.rules_synced_at >= settings.TWITTER_STREAM_RULES_REFRESH_INTERVAL:
+                self.sync_rules()
+
+    def run(self):
+        self.kill_previous()
+        self.write_pid()
+        signal.signal(signal.SIGTERM, StreamClient.shutdown)
+        signal.signal(signal.SIGINT, StreamClient.shutdown)
+        backoff = None
+        try:
+            while True:
+                try:
+                    # the first sync goes through the same backoff as the
+                    # stream, it fails the same way when twitter is down
+                    if self.matcher is None:
+                        self.sync_rules()
+                    self.consume()
+                    backoff = None
+                except requests.HTTPError as ex:
+                    min_backoff = self.MIN_RATE_LIMIT_BACKOFF if ex.response.status_code == 429 else self.MIN_BACKOFF
+                    backoff = min(self.MAX_BACKOFF, backoff * 2 if backoff else min_backoff)
+                    _LOG.warning('stream failed with:[%s]. reconnecting in %ss', ex, backoff)
+                except (requests.ConnectionError, requests.Timeout) as ex:
+                    backoff = min(self.MAX_BACKOFF, backoff * 2 if backoff else self.MIN_BACKOFF)
+                    _LOG.warning('stream disconnected with:[%s]. reconnecting in %ss', ex, backoff)
+                else:
+                    _LOG.info('stream closed. reconnecting')
+                self.flush()
+                if backoff:
+                    time.sleep(backoff)
+        finally:
+            self.flush()
+
+    @classmethod
+    def kill_previous(cls):
+        if not os.path.exists(cls.PID_FILE):
+            return
+        pid = open(cls.PID_FILE).read()
+        if not pid or int(pid) == os.getpid():
+            return
+        try:
+            old = psutil.Process(int(pid))
+            cmdline = ' '.join(old.cmdline())
+        except (psutil.NoSuchProcess, psutil.AccessDenied):
+            _LOG.info('current.pid has invalid pid. removing...')
+            os.remove(cls.PID_FILE)
+            return
+        if 'twitter_listener' not in cmdline:
+            # the pid has been reused by something else since the last run
+            _LOG.info('current.pid belongs to another process:[%s]. removing...', cmdline)
+            os.remove(cls.PID_FILE)
+        else:
+            _LOG.info('current.pid belongs to previous run. killing...')
+            old.terminate()
+            old.wait()
+
+    @classmethod
+    def write_pid(cls):
+        pid = str(os.getpid())
+        _LOG.info('write pid:[%s] to current.pid', pid)
+        open(cls.PID_FILE, 'w').write(pid)
+
+    @classmethod
+    def shutdown(cls, signum, frame):
+        _LOG.info('shutting down...')
+        if os.path.exists(cls.PID_FILE) and open(cls.PID_FILE).read() == str(os.getpid()):
+            os.remove(cls.PID_FILE)
+        raise SystemExit(0)
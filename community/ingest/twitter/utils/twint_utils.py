@@ -1,13 +1,23 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import datetime
+from functools import partial
+import json
 import logging
+import multiprocessing
+import os
 import string
+import time
 
+import aiohttp
 from retry import retry
 import twint
 
+from community.app import settings
 from community.platform.utils.file_utils import mkdirs
 
 _LOG = logging.getLogger(__name__)
+RETRY_EXCEPTIONS = (aiohttp.ClientError, asyncio.TimeoutError, ConnectionError)
 PUNCT = set(string.punctuation)
 PUNCT.add(' ')
 
@@ -24,6 +34,25 @@ def slugify(s, joiner='_', retain_punct=None):
     return joiner.join(filter(bool, ''.join(result).split(joiner)))
 
 
+QUERY_USERNAME = 'username'
+QUERY_SEARCH = 'search'
+
+
+def get_query(job, crawl_type):
+    # mentions and replies are the same search, and jobs of different
+    # projects can ask for the same handle or hashtag. queries are compared
+    # in this normalized form so that each of them is scraped only once
+    term = job.query.lower().lstrip('@#')
+    if crawl_type == CrawlBuffer.CRAWL_TYPE_TWEETS:
+        return QUERY_USERNAME, term
+    elif crawl_type in (CrawlBuffer.CRAWL_TYPE_MENTIONS, CrawlBuffer.CRAWL_TYPE_REPLIES):
+        return QUERY_SEARCH, '@' + term
+    elif crawl_type == CrawlBuffer.CRAWL_TYPE_HASHTAG:
+        return QUERY_SEARCH, '#' + term
+    else:
+        return QUERY_SEARCH, job.query
+
+
 class CrawlBuffer(object):
     CRAWL_TYPE_TWEETS = 0
     CRAWL_TYPE_MENTIONS = 1
@@ -36,17 +65,41 @@ class CrawlBuffer(object):
         CRAWL_TYPE_REPLIES
     )
 
-    def __init__(self, job, crawl_type, limit=None, since=None, until=None,
-                 language=None, buffer_size=25 * 1000):
+    # rough per-row overhead of the tuple and its ints/datetime on top of the
+    # two strings, so that the byte budget tracks actual memory use
+    ROW_OVERHEAD_BYTES = 200
+    TWEET_FIELDS = ('id', 'message', 'timestamp', 'user_id', 'job_id', 'data')
+
+    def __init__(self, query, targets, limit=None, since=None, until=None,
+                 language=None, buffer_bytes=32 * 1024 * 1024):
+        c = self.get_twint_config(query, limit=limit, since=since, until=until, language=language)
+        c.Store_object = True
+        c.Store_object_tweets_list = self
+
+        self.twint_config = c
+        # (job_id, since, until) of every job that wants tweets from this query
+        self.targets = targets
+        self.signature_parts = list(map(str, list(query) + sorted(job_id for job_id, _, _ in targets)))
+        # windows of a backfill each get their own resume file
+        self.signature_parts.extend(filter(None, [since, until]))
+
+        c.Resume = self.resume_fname
+
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.max_buffer_bytes = buffer_bytes
+        self.executor = None
+        self.pending = None
+        self.error = None
+
+    @classmethod
+    def get_twint_config(cls, query, limit=None, since=None, until=None, language=None):
+        kind, term = query
         c = twint.Config()
-        if crawl_type == self.CRAWL_TYPE_TWEETS:
-            c.Username = job.query
-        elif crawl_type in (self.CRAWL_TYPE_MENTIONS, self.CRAWL_TYPE_REPLIES):
-            c.Search = '@' + job.query
-        elif crawl_type == self.CRAWL_TYPE_HASHTAG:
-            c.Search = '#' + job.query
+        if kind == QUERY_USERNAME:
+            c.Username = term
         else:
-            c.Search = job.query
+            c.Search = term
 
         if since:
             c.Since = since
@@ -59,18 +112,7 @@ class CrawlBuffer(object):
 
         if language:
             c.Lang = language
-
-        c.Store_object = True
-        c.Store_object_tweets_list = self
-
-        self.twint_config = c
-        self.job = job
-        self.signature_parts = map(str, [job.query, job.crawl_type, job.id])
-
-        c.Resume = self.resume_fname
-
-        self.buffer = []
-        self.buffer_size = buffer_size
+        return c
 
     @property
     def resume_fname(self):
@@ -79,31 +121,398 @@ class CrawlBuffer(object):
         s = slugify('_'.join(self.signature_parts), retain_punct={'@'})
         return prefix % s
 
+    @staticmethod
+    def parse_timestamp(s):
+        # twint gives '%Y-%m-%d %H:%M:%S %Z' in the local time of the host it
+        # runs on. the crawlers run on UTC hosts (see check_timezone) so it is
+        # taken as UTC as is. converting it would move tweets that are already
+        # stored to another (id, timestamp) key and duplicate them on recrawl
+        return datetime.datetime.fromisoformat(s[:19])
+
+    @staticmethod
+    def check_timezone():
+        if time.localtime().tm_gmtoff:
+            _LOG.warning('host is not on UTC (%s). twint timestamps are stored in local time',
+                         time.strftime('%Z'))
+
+    def get_job_ids(self, timestamp):
+        # since is inclusive and until exclusive, like twint's own filter
+        day = timestamp.strftime('%Y-%m-%d')
+        return tuple(job_id for job_id, since, until in self.targets
+                     if (not since or day >= since[:10]) and (not until or day < until[:10]))
+
+    def to_row(self, tweet):
+        d = vars(tweet)
+        timestamp = self.parse_timestamp(d['datetime'])
+        return (d['id'], d['tweet'], timestamp, d['user_id'], self.get_job_ids(timestamp),
+                json.dumps(d, default=str))
+
+    def _write(self, rows):
+        from community.ingest.twitter.models import Tweet, TweetJob
+
+        # the tweet is stored once, under the first job that asked for it, and
+        # linked to every job whose window it falls in
+        rows = [row for row in rows if row[4]]
+        Tweet.bulk_create_rows((dict(zip(self.TWEET_FIELDS, row[:4] + (row[4][0],) + row[5:])) for row in rows),
+                               strategy=Tweet.BULK_STRATEGY_COPY)
+        TweetJob.link(((row[0], job_id) for row in rows for job_id in row[4]), strategy=TweetJob.BULK_STRATEGY_COPY)
+
+    def wait(self):
+        # keeps the first error of the background writes
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            try:
+                pending.result()
+            except Exception as ex:
+                _LOG.exception('write failed for [%s] - %s', self.signature_parts, ex)
+                if self.error is None:
+                    self.error = ex
+
     def flush(self):
-        from community.ingest.twitter.models import Tweet
-
-        _LOG.info('flushing buffer for [%s]', self.signature_parts)
-        objs = []
-        for d in self.buffer:
-            objs.append(Tweet(job=self.job,
-                              id=d['id'],
-                              message=d['tweet'],
-                              timestamp=datetime.datetime.strptime(d['datetime'], '%Y-%m-%d %H:%M:%S %Z'),
-                              user_id=d['user_id'],
-                              data=d))
-        Tweet.bulk_create(objs)
+        # a failed write is raised on close, after the rest of the window is dropped
+        _LOG.info('flushing buffer for [%s] rows:[%s] bytes:[%s]',
+                  self.signature_parts, len(self.buffer), self.buffer_bytes)
+        # twint keeps scraping while the previous buffer is written. at most
+        # one write is in flight so memory stays at ~2x the budget
+        self.wait()
+        if self.error is not None:
+            self.buffer = []
+            self.buffer_bytes = 0
+            return
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='crawl_buffer')
+        self.pending = self.executor.submit(self._write, self.buffer)
         self.buffer = []
+        self.buffer_bytes = 0
 
     def append(self, tweet):
-        self.buffer.append(vars(tweet))
-        if len(self.buffer) >= self.buffer_size:
+        if self.error is not None:
+            # the window has failed already. it is crawled again from the start
+            return
+        row = self.to_row(tweet)
+        self.buffer.append(row)
+        self.buffer_bytes += len(row[1]) + len(row[5]) + self.ROW_OVERHEAD_BYTES
+        if self.buffer_bytes >= self.max_buffer_bytes:
             self.flush()
 
     def close(self):
-        if self.buffer:
+        from community.platform.utils.orm_utils import remove_session
+
+        if self.buffer and self.error is None:
             self.flush()
+        self.wait()
+        self.buffer = []
+        self.buffer_bytes = 0
+        if self.executor is not None:
+            self.executor.submit(remove_session).result()
+            self.executor.shutdown()
+            self.executor = None
 
-    @retry(tries=1000)
+        if self.error is not None:
+            # twint has moved the resume point past the tweets that were not
+            # written, so the window starts over instead of resuming
+            if os.path.exists(self.twint_config.Resume):
+                os.remove(self.twint_config.Resume)
+            raise self.error
+
+    # only network errors are retried, from where the resume file left off.
+    # anything else (a failed write, a bad query) fails the crawl
+    @retry(RETRY_EXCEPTIONS, tries=5, delay=10, backoff=2, max_delay=300, logger=_LOG)
     def start_crawl(self):
+        self.error = None
         twint.run.Search(self.twint_config)
         self.close()
+
+
+class BackfillPlan(object):
+    # splits a long crawl into date windows that are crawled independently.
+    # the windows and the targets they have been crawled for are kept in a
+    # json file so that a rerun picks up where the last one stopped
+    DATE_FORMAT = '%Y-%m-%d'
+    TWITTER_EPOCH = datetime.date(2006, 3, 21)
+    PROBE_LIMIT = 500
+    MIN_WINDOW_DAYS = 1
+    MAX_WINDOW_DAYS = 365
+
+    def __init__(self, query, targets, since=None, until=None):
+        self.query = query
+        self.targets = targets
+        # the state file is keyed on the bounds as given. an open until would
+        # otherwise give a new file, and a fresh backfill, every day
+        self.bounds = (since[:10] if since else 'open', until[:10] if until else 'open')
+        self.since = self.parse_date(since) if since else self.TWITTER_EPOCH
+        self.until = self.parse_date(until) if until else datetime.date.today() + datetime.timedelta(days=1)
+        self.windows = []
+        # window -> [(job_id, since, until), ...] it was crawled for
+        self.done = {}
+
+    @classmethod
+    def parse_date(cls, s):
+        return datetime.datetime.strptime(s[:10], cls.DATE_FORMAT).date()
+
+    @property
+    def fname(self):
+        mkdirs('state/twint/')
+        parts = list(self.query) + list(self.bounds)
+        return 'state/twint/backfill_%s.json' % slugify('_'.join(map(str, parts)), retain_punct={'@'})
+
+    def estimate_density(self):
+        # tweets per day, from the newest PROBE_LIMIT tweets in the range.
+        # recent activity is usually the busiest so older windows come out
+        # smaller than needed rather than larger
+        tweets = []
+        c = CrawlBuffer.get_twint_config(self.query,
+                                         limit=self.PROBE_LIMIT,
+                                         since=self.since.strftime(self.DATE_FORMAT),
+                                         until=self.until.strftime(self.DATE_FORMAT))
+        c.Store_object = True
+        c.Store_object_tweets_list = tweets
+        c.Hide_output = True
+        twint.run.Search(c)
+        if not tweets:
+            return 0
+
+        if len(tweets) < self.PROBE_LIMIT:
+            oldest = datetime.datetime.combine(self.since, datetime.time())
+        else:
+            oldest = min(CrawlBuffer.parse_timestamp(t.datetime) for t in tweets)
+        until = datetime.datetime.combine(self.until, datetime.time())
+        days = max((until - oldest).total_seconds() / 86400, 1)
+        return len(tweets) / days
+
+    def get_window_days(self):
+        density = self.estimate_density()
+        if not density:
+            return self.MAX_WINDOW_DAYS
+        days = int(settings.TWINT_BACKFILL_TWEETS_PER_WINDOW / density)
+        return min(max(days, self.MIN_WINDOW_DAYS), self.MAX_WINDOW_DAYS)
+
+    def make_windows(self, start=None):
+        start = start or self.since
+        window_days = self.get_window_days()
+        _LOG.info('backfill for [%s] from %s to %s in %s day windows',
+                  self.query, start, self.until, window_days)
+        windows = []
+        while start < self.until:
+            end = min(start + datetime.timedelta(days=window_days), self.until)
+            windows.append((start.strftime(self.DATE_FORMAT), end.strftime(self.DATE_FORMAT)))
+            start = end
+        return windows
+
+    def load(self):
+        try:
+            with open(self.fname) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            self.windows = self.make_windows()
+            self.save()
+        else:
+            self.windows = [tuple(w) for w in state['windows']]
+            # files written before targets were tracked have no done_targets,
+            # so their windows are crawled once more
+            self.done = {tuple(d['window']): [tuple(t) for t in d['targets']]
+                         for d in state.get('done_targets', [])}
+            # an open-ended plan is extended up to today on every run
+            last = self.parse_date(self.windows[-1][1]) if self.windows else self.since
+            if last < self.until:
+                self.windows.extend(self.make_windows(start=last))
+                self.save()
+        return self
+
+    def save(self):
+        state = {
+            'windows': self.windows,
+            'done_targets': [{'window': window, 'targets': targets}
+                             for window, targets in sorted(self.done.items())],
+        }
+        with open(self.fname, 'w') as f:
+            json.dump(state, f)
+
+    @staticmethod
+    def clip(target, window):
+        # the part of the window that a target asked for, as (start, end)
+        _, since, until = target
+        start = max(since[:10], window[0]) if since else window[0]
+        end = min(until[:10], window[1]) if until else window[1]
+        return start, end
+
+    def get_missing_targets(self, window):
+        done = {job_id for job_id, _, _ in self.done.get(window, [])}
+        missing = []
+        for target in self.targets:
+            start, end = self.clip(target, window)
+            if target[0] not in done and start < end:
+                missing.append(target)
+        return missing
+
+    def is_covered(self, window, targets):
+        # whether the tweets stored for the targets the window was crawled
+        # for span every day that the given targets ask for
+        spans = sorted(self.clip(t, window) for t in self.done.get(window, []))
+        for target in targets:
+            start, end = self.clip(target, window)
+            for span_start, span_end in spans:
+                if span_start <= start < span_end:
+                    start = span_end
+            if start < end:
+                return False
+        return True
+
+    def get_pending_windows(self):
+        # (window, missing targets, is_covered). a covered window has been
+        # crawled before for other jobs and only needs linking
+        pending = []
+        for window in self.windows:
+            missing = self.get_missing_targets(window)
+            if missing:
+                pending.append((window, missing, self.is_covered(window, missing)))
+        return pending
+
+    def link_existing(self, window, targets):
+        from community.ingest.twitter.models import TweetJob
+
+        source_job_ids = sorted({job_id for job_id, _, _ in self.done[window]})
+        for target in targets:
+            start, end = self.clip(target, window)
+            linked = TweetJob.copy_links(source_job_ids, target[0],
+                                         since=self.parse_date(start), until=self.parse_date(end))
+            _LOG.info('linked %s stored tweets of [%s] %s to job:[%s]', linked, self.query, window, target[0])
+        self.mark_done(window, targets)
+
+    def mark_done(self, window, targets, crawl_date=None):
+        # a window that ends after the (utc) day the crawl started on is only
+        # complete up to that day. the rest is split off and stays pending
+        if crawl_date is not None:
+            cutoff = crawl_date.strftime(self.DATE_FORMAT)
+            since, until = window
+            if until > cutoff:
+                if since >= cutoff:
+                    return
+                i = self.windows.index(window)
+                self.windows[i:i + 1] = [(since, cutoff), (cutoff, until)]
+                if window in self.done:
+                    self.done[(since, cutoff)] = self.done.pop(window)
+                window = (since, cutoff)
+        done = {t[0]: tuple(t) for t in self.done.get(window, []) + list(targets)}
+        self.done[window] = [done[job_id] for job_id in sorted(done)]
+        self.save()
+
+
+def should_backfill(config):
+    if not config.get('since'):
+        return True
+    since = BackfillPlan.parse_date(config['since'])
+    until = BackfillPlan.parse_date(config['until']) if config.get('until') else datetime.date.today()
+    return (until - since).days > settings.TWINT_BACKFILL_MIN_DAYS
+
+
+def merge_windows(targets):
+    # groups targets whose windows overlap so that each group is scraped once
+    # over the union of its windows. a missing since or until is unbounded
+    groups = []
+    for target in sorted(targets, key=lambda t: t[1] or ''):
+        _, since, until = target
+        if groups:
+            group_since, group_until, group_targets = groups[-1]
+            if group_until is None or (since or '') <= group_until:
+                if until is None or group_until is None:
+                    group_until = None
+                else:
+                    group_until = max(group_until, until)
+                groups[-1] = (group_since, group_until, group_targets + [target])
+                continue
+        groups.append((since, until, [target]))
+    return groups
+
+
+def plan_crawls(jobs):
+    # returns (query, config, targets) for every distinct query and window
+    # needed by the jobs. options other than the window have to match for
+    # jobs to share a crawl
+    by_query = {}
+    for job in jobs:
+        config = job.cleaned_config
+        options = json.dumps({k: v for k, v in config.items() if k not in ('since', 'until')}, sort_keys=True)
+        for crawl_type in job.get_twint_crawl_types():
+            targets = by_query.setdefault((get_query(job, crawl_type), options), {})
+            targets[job.id] = (job.id, config['since'], config['until'])
+
+    plans = []
+    for (query, options), targets in by_query.items():
+        for since, until, group in merge_windows(targets.values()):
+            plans.append((query, dict(json.loads(options), since=since, until=until), group))
+    _LOG.info('planned %s twint queries for %s jobs', len(plans), len(jobs))
+    return plans
+
+
+def crawl(query, targets, config):
+    # entrypoint for pool workers, so everything it gets is picklable
+    CrawlBuffer(query, targets, **config).start_crawl()
+
+
+def run_tasks(tasks, max_workers):
+    # tasks are (query, targets, config, on_done). on_done is called in this
+    # process once the crawl has finished. a failed crawl doesn't stop the
+    # others, the failures are returned as (query, targets, ex)
+    failures = []
+    max_workers = min(max_workers, len(tasks))
+    if max_workers <= 1:
+        for query, targets, config, on_done in tasks:
+            try:
+                crawl(query, targets, config)
+            except Exception as ex:
+                _LOG.exception('crawl failed for %s - %s', query, ex)
+                failures.append((query, targets, ex))
+            else:
+                if on_done is not None:
+                    on_done()
+        return failures
+
+    # spawn so that workers don't inherit the parent's db connections. each
+    # task has its own resume file and writes on its own
+    _LOG.info('crawling %s tasks with %s workers', len(tasks), max_workers)
+    ctx = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=max_workers, mp_context=ctx) as executor:
+        futures = {executor.submit(crawl, query, targets, config): (query, targets, on_done)
+                   for query, targets, config, on_done in tasks}
+        for future in as_completed(futures):
+            query, targets, on_done = futures[future]
+            try:
+                future.result()
+            except Exception as ex:
+                _LOG.exception('crawl failed for %s - %s', query, ex)
+                failures.append((query, targets, ex))
+            else:
+                if on_done is not None:
+                    on_done()
+    return failures
+
+
+def run_crawls(jobs):
+    # returns {job_id: (query, ex)} for the jobs that had a crawl fail
+    tasks = []
+    is_backfill = False
+    crawl_date = datetime.datetime.utcnow().date()
+    CrawlBuffer.check_timezone()
+    for query, config, targets in plan_crawls(jobs):
+        if should_backfill(config):
+            is_backfill = True
+            plan = BackfillPlan(query, targets, since=config['since'], until=config['until']).load()
+            for window, missing, is_covered in plan.get_pending_windows():
+                if is_covered:
+                    plan.link_existing(window, missing)
+                    continue
+                since, until = window
+                tasks.append((query, targets, dict(config, since=since, until=until),
+                              partial(plan.mark_done, window, targets, crawl_date)))
+        else:
+            tasks.append((query, targets, config, None))
+    if not tasks:
+        return {}
+
+    failures = run_tasks(tasks, settings.TWINT_BACKFILL_WORKERS if is_backfill else settings.TWINT_MAX_PARALLEL_CRAWLS)
+    failed = {}
+    for query, targets, ex in failures:
+        for job_id, _, _ in targets:
+            failed.setdefault(job_id, (query, ex))
+    return failed
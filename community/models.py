@@ -1,18 +1,41 @@
-import copy
+from contextlib import contextmanager
+import importlib
+import logging
 
-from sqlalchemy import create_engine
-from sqlalchemy.exc import IntegrityError, NoResultFound
-from sqlalchemy.orm import declared_attr
+from sqlalchemy import event
+from sqlalchemy.orm import Mapper, declared_attr
 from sqlalchemy.ext.declarative import declarative_base
 
-from community.app import settings
+_LOG = logging.getLogger(__name__)
 
 
 class Base(object):
+    BULK_STRATEGY_INSERT = 'insert'
+    BULK_STRATEGY_COPY = 'copy'
+    BULK_INSERT_CHUNK_SIZE = 1000
+    BULK_COPY_CHUNK_SIZE = 50 * 1000
+    # columns with a unique index that bulk_upsert uses as the ON CONFLICT
+    # target. defaults to the primary key
+    UPSERT_CONFLICT_COLUMNS = None
+
     @declared_attr
     def __tablename__(cls):
         return cls.__name__.lower()
 
+    @declared_attr
+    def __table_args__(cls):
+        return tuple(cls.get_table_args()) + (cls.get_table_options(),)
+
+    @classmethod
+    def get_table_args(cls):
+        # indexes and constraints for __table_args__
+        return []
+
+    @classmethod
+    def get_table_options(cls):
+        # dialect options for __table_args__
+        return {}
+
     @classmethod
     def get_table_columns(cls):
         return list(cls.metadata.tables[cls.__name__.lower()].c.keys())
@@ -22,95 +45,145 @@ class Base(object):
         from community.platform.utils.orm_utils import session_factory
         return session_factory()
 
+    @staticmethod
+    def replica_session_factory():
+        from community.platform.utils.orm_utils import replica_session_factory
+        return replica_session_factory()
+
+    @staticmethod
+    def session_scope():
+        from community.platform.utils.orm_utils import session_scope
+        return session_scope()
+
     @classmethod
     def get_or_create(cls, defaults=None, **kwargs):
         from community.platform.utils.orm_utils import get_or_create
         return get_or_create(cls, defaults=defaults, **kwargs)
 
     @classmethod
-    def bulk_create(cls, objs):
-        session = cls.session_factory()
-        # session.add_all(objs)
-        # session.commit()
-        for obj in objs:
-            session.add(obj)
-            try:
-                session.commit()
-            except IntegrityError:
-                session.rollback()
+    async def async_get(cls, **kwargs):
+        from community.platform.utils.orm_utils import async_get
+        return await async_get(cls, **kwargs)
 
     @classmethod
-    def bulk_update(cls, objs):
-        session = cls.session_factory()
-        cols = cls.get_table_columns()
-        for obj in objs:
-            db_obj = session.query(cls).filter(cls.id == obj.id).one()
-            session.add(db_obj)
-            for col in cols:
-                val = getattr(obj, col)
-                if val is not None:
-                    if isinstance(val, dict):
-                        old_val = copy.copy(getattr(db_obj, col) or {})
-                        old_val.update(val)
-                        val = old_val
-                    setattr(db_obj, col, val)
-            session.commit()
+    async def async_get_or_create(cls, defaults=None, **kwargs):
+        from community.platform.utils.orm_utils import async_get_or_create
+        return await async_get_or_create(cls, defaults=defaults, **kwargs)
 
     @classmethod
-    def bulk_upsert(cls, objs):
-        session = cls.session_factory()
-        for obj in objs:
-            try:
-                db_obj = session.query(cls).filter(cls.id == obj.id).one()
-            except NoResultFound:
-                session.add(obj)
-            else:
-                session.add(db_obj)
-                db_obj.data = db_obj.data or {}
-                db_obj.data.update(obj.data)
-            finally:
-                session.commit()
+    def bulk_create(cls, objs, chunk_size=None, strategy=BULK_STRATEGY_INSERT):
+        from community.platform.utils.orm_utils import to_row
+
+        rows = (to_row(obj) for obj in objs)
+        return cls.bulk_create_rows(rows, chunk_size=chunk_size, strategy=strategy)
+
+    @classmethod
+    def bulk_create_rows(cls, rows, chunk_size=None, strategy=BULK_STRATEGY_INSERT):
+        from community.platform.utils.orm_utils import bulk_copy, bulk_insert
+
+        # rows are dicts keyed by column. skips building ORM objects for
+        # callers that already have plain values
+        if strategy == cls.BULK_STRATEGY_COPY:
+            results = bulk_copy(cls, rows, chunk_size=chunk_size or cls.BULK_COPY_CHUNK_SIZE)
+        elif strategy == cls.BULK_STRATEGY_INSERT:
+            results = bulk_insert(cls, rows, chunk_size=chunk_size or cls.BULK_INSERT_CHUNK_SIZE)
+        else:
+            raise ValueError('unsupported strategy:%s' % strategy)
+        _LOG.info('%s.bulk_create: inserted:[%s] skipped:[%s] failed:[%s] batches:[%s]', cls.__name__,
+                  sum(r.inserted for r in results), sum(r.skipped for r in results),
+                  sum(r.failed for r in results), len(results))
+        return results
 
     @classmethod
-    def saving(cls):
-        class CtxMgr(object):
-            def __enter__(self):
-                self.session = Base.session_factory()
+    async def async_bulk_create(cls, objs, chunk_size=None):
+        from community.platform.utils.orm_utils import async_bulk_insert, to_row
 
-            def __exit__(self, exc_type, exc_val, exc_tb):
-                self.session.commit()
+        rows = (to_row(obj) for obj in objs)
+        results = await async_bulk_insert(cls, rows, chunk_size=chunk_size or cls.BULK_INSERT_CHUNK_SIZE)
+        _LOG.info('%s.async_bulk_create: inserted:[%s] skipped:[%s] failed:[%s] batches:[%s]', cls.__name__,
+                  sum(r.inserted for r in results), sum(r.skipped for r in results),
+                  sum(r.failed for r in results), len(results))
+        return results
 
-        return CtxMgr()
+    @classmethod
+    def bulk_update(cls, objs, chunk_size=None):
+        from community.platform.utils.orm_utils import bulk_update, to_row
+
+        # relationships like job=self are deliberately not applied so that an
+        # update never moves a row to another job
+        rows = [to_row(obj, with_relationships=False) for obj in objs]
+        results = bulk_update(cls, rows, chunk_size=chunk_size or cls.BULK_INSERT_CHUNK_SIZE)
+        _LOG.info('%s.bulk_update: updated:[%s] missing:[%s] batches:[%s]', cls.__name__,
+                  sum(r.updated for r in results), sum(r.missing for r in results), len(results))
+        return results
 
     @classmethod
-    def filter(cls, *args):
-        session = cls.session_factory()
+    def bulk_upsert(cls, objs, conflict_columns=None, chunk_size=None, update_columns=()):
+        from community.platform.utils.orm_utils import bulk_upsert, to_row
+
+        if conflict_columns is None:
+            conflict_columns = cls.UPSERT_CONFLICT_COLUMNS or [c.key for c in cls.__table__.primary_key]
+        rows = [to_row(obj) for obj in objs]
+        results = bulk_upsert(cls, rows, conflict_cols=list(conflict_columns),
+                              chunk_size=chunk_size or cls.BULK_INSERT_CHUNK_SIZE,
+                              update_cols=list(update_columns))
+        _LOG.info('%s.bulk_upsert: inserted:[%s] updated:[%s] skipped:[%s] batches:[%s]', cls.__name__,
+                  sum(r.inserted for r in results), sum(r.updated for r in results),
+                  sum(r.skipped for r in results), len(results))
+        return results
+
+    @contextmanager
+    def saving(self):
+        with self.session_scope() as session:
+            session.add(self)
+            yield session
+
+    @classmethod
+    def filter(cls, *args, replica=False):
+        session = cls.replica_session_factory() if replica else cls.session_factory()
         return session.query(cls).filter(*args)
 
     @classmethod
     def create(cls, **kwargs):
         obj = cls(**kwargs)
-        session = cls.session_factory()
-        session.add(obj)
-        session.commit()
+        with cls.session_scope() as session:
+            session.add(obj)
         return obj
 
     def delete(self):
-        session = self.session_factory()
-        session.delete(self)
-        session.commit()
+        with self.session_scope() as session:
+            session.delete(self)
 
     @classmethod
-    def query(cls, *args):
-        session = cls.session_factory()
+    def query(cls, *args, replica=False):
+        session = cls.replica_session_factory() if replica else cls.session_factory()
         return session.query(*args)
 
 
 Base = declarative_base(cls=Base)
+MODEL_MODULES = (
+    'community.platform.models',
+    'community.ingest.models',
+)
+
+
+def import_models():
+    # models are imported on demand instead of at import time so that short
+    # lived processes only pay for the modules they actually touch
+    return [importlib.import_module(name) for name in MODEL_MODULES]
+
 
+@event.listens_for(Mapper, 'before_configured')
+def _import_models_before_configure():
+    # relationships refer to models by name, so every model has to be
+    # registered before the mappers get configured
+    import_models()
 
-from community.platform.models import *  # noqa
-from community.ingest.models import *  # noqa
 
-engine = create_engine(settings.DATABASE_URL, echo=True)
-Base.metadata.create_all(engine)
+def __getattr__(name):
+    if name.startswith('__'):
+        raise AttributeError(name)
+    for module in import_models():
+        if hasattr(module, name):
+            return getattr(module, name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
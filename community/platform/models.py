@@ -62,9 +62,8 @@ class Project(Base):
         cols = ['discord_username', 'github_username', 'twitter_username', 'name', 'data']
         insert_query = u_table.insert() \
                               .from_select(cols, new_users)
-        session = self.session_factory()
-        session.execute(insert_query)
-        session.commit()
+        with self.session_scope() as session:
+            session.execute(insert_query)
 
 
 class User(Base):
@@ -82,8 +81,9 @@ class User(Base):
 
     @classmethod
     def unique_users(cls):
-        users = cls.filter(cls.duplicate_of_id.is_(None))
-        dup_users = cls.filter().subquery()
+        session = cls.replica_session_factory()
+        users = session.query(cls).filter(cls.duplicate_of_id.is_(None))
+        dup_users = session.query(cls).subquery()
         qs = users.join(dup_users, (cls.id == dup_users.c.duplicate_of_id) | (cls.id == dup_users.c.id))\
                   .with_entities(cls.id,
                                  cls.name,
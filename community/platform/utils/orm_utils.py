@@ -1,30 +1,505 @@
-from sqlalchemy.orm import sessionmaker
+import asyncio
+from collections import namedtuple
+from contextlib import asynccontextmanager, contextmanager
+import datetime
+import io
+import json
+import logging
+import threading
+import time
+import weakref
 
-from community.models import engine
+from sqlalchemy import and_, cast, column, create_engine, func, inspect, literal_column, select, text, values
+from sqlalchemy.dialects.postgresql import JSONB, insert
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.interfaces import MANYTOONE
+from sqlalchemy.util import ThreadLocalRegistry
 
-_SessionFactory = sessionmaker(bind=engine)
-SESSION = None
+from community.app import settings
+from community.platform.utils.iter_utils import chunkify
+from community.platform.utils.pool_utils import TimedQueuePool
+from community.platform.utils.replica_utils import REPLICA_LAG_SQL, ReplicaLagCheck
+
+_LOG = logging.getLogger(__name__)
+
+BulkResult = namedtuple('BulkResult', ['inserted', 'skipped', 'failed'], defaults=(0,))
+UpsertResult = namedtuple('UpsertResult', ['inserted', 'updated', 'skipped'])
+UpdateResult = namedtuple('UpdateResult', ['updated', 'missing'])
+EMPTY_JSONB = literal_column("'{}'::jsonb", type_=JSONB)
+ENGINE = None
+REPLICA_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+_REPLICA_LAG_CHECK = None
+_ASYNC_ENGINES = weakref.WeakKeyDictionary()
+
+
+def _create_engine(url):
+    return create_engine(url,
+                         echo=settings.LOG_LEVEL <= logging.DEBUG,
+                         poolclass=TimedQueuePool,
+                         pool_size=settings.DB_POOL_SIZE,
+                         max_overflow=settings.DB_MAX_OVERFLOW,
+                         pool_timeout=settings.DB_POOL_TIMEOUT,
+                         pool_recycle=settings.DB_POOL_RECYCLE,
+                         pool_pre_ping=settings.DB_POOL_PRE_PING)
+
+
+def get_engine():
+    global ENGINE
+
+    if ENGINE is None:
+        with _ENGINE_LOCK:
+            if ENGINE is None:
+                ENGINE = _create_engine(settings.DATABASE_URL)
+                Session.configure(bind=ENGINE)
+    return ENGINE
+
+
+def get_replica_engine():
+    global REPLICA_ENGINE, _REPLICA_LAG_CHECK
+
+    if settings.DATABASE_REPLICA_URL is None:
+        return None
+    if REPLICA_ENGINE is None:
+        with _ENGINE_LOCK:
+            if REPLICA_ENGINE is None:
+                REPLICA_ENGINE = _create_engine(settings.DATABASE_REPLICA_URL)
+                ReplicaSession.configure(bind=REPLICA_ENGINE)
+                _REPLICA_LAG_CHECK = ReplicaLagCheck('replica', get_replica_lag)
+    return REPLICA_ENGINE
+
+
+def get_async_engine():
+    # asyncpg connections belong to the event loop that opened them, so each
+    # loop gets its own engine
+    loop = asyncio.get_running_loop()
+    engine = _ASYNC_ENGINES.get(loop)
+    if engine is None:
+        url = make_url(settings.DATABASE_URL).set(drivername='postgresql+asyncpg')
+        engine = create_async_engine(url,
+                                     echo=settings.LOG_LEVEL <= logging.DEBUG,
+                                     pool_size=settings.DB_POOL_SIZE,
+                                     max_overflow=settings.DB_MAX_OVERFLOW,
+                                     pool_timeout=settings.DB_POOL_TIMEOUT,
+                                     pool_recycle=settings.DB_POOL_RECYCLE,
+                                     pool_pre_ping=settings.DB_POOL_PRE_PING)
+        _ASYNC_ENGINES[loop] = engine
+    return engine
+
+
+async def dispose_async_engine():
+    # to be awaited at the end of the coroutine given to asyncio.run(). the
+    # loop's engine would otherwise hold its connections until the process exits
+    engine = _ASYNC_ENGINES.pop(asyncio.get_running_loop(), None)
+    if engine is not None:
+        await engine.dispose()
+
+
+def get_replica_lag():
+    with get_replica_engine().connect() as conn:
+        return conn.execute(text(REPLICA_LAG_SQL)).scalar()
+
+
+def get_current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:
+        return None
+
+
+class TaskLocalRegistry(ThreadLocalRegistry):
+    # one session per asyncio task when inside an event loop, otherwise one
+    # per thread like a plain scoped_session. task sessions are closed when
+    # the task finishes
+    def __init__(self, createfunc):
+        super().__init__(createfunc)
+        self.tasks = {}
+
+    def __call__(self):
+        task = get_current_task()
+        if task is None:
+            return super().__call__()
+        session = self.tasks.get(task)
+        if session is None:
+            session = self.tasks[task] = self.createfunc()
+            task.add_done_callback(self.remove_task)
+        return session
+
+    def has(self):
+        task = get_current_task()
+        if task is None:
+            return super().has()
+        return task in self.tasks
+
+    def set(self, obj):
+        task = get_current_task()
+        if task is None:
+            super().set(obj)
+        else:
+            self.tasks[task] = obj
+
+    def clear(self):
+        task = get_current_task()
+        if task is None:
+            super().clear()
+        else:
+            self.tasks.pop(task, None)
+
+    def remove_task(self, task):
+        session = self.tasks.pop(task, None)
+        if session is not None:
+            session.close()
+
+
+def make_scoped_session():
+    session = scoped_session(sessionmaker(expire_on_commit=False))
+    session.registry = TaskLocalRegistry(session.session_factory)
+    return session
+
+
+Session = make_scoped_session()
+ReplicaSession = make_scoped_session()
 
 
 def session_factory():
-    # return _SessionFactory()
+    get_engine()
+    return Session()
+
 
-    global SESSION
+def replica_session_factory():
+    # for reads that can live with slightly stale data. falls back to the
+    # primary when no replica is configured or it lags too far behind
+    if get_replica_engine() is None or not _REPLICA_LAG_CHECK.is_usable():
+        return session_factory()
+    return ReplicaSession()
 
-    if SESSION is None:
-        SESSION = _SessionFactory(expire_on_commit=False)
-    return SESSION
+
+def remove_session():
+    # to be called by threads that are done talking to the db
+    Session.remove()
+    ReplicaSession.remove()
+
+
+@contextmanager
+def session_scope():
+    session = session_factory()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+
+
+@asynccontextmanager
+async def async_session_scope():
+    async with AsyncSession(bind=get_async_engine(), expire_on_commit=False) as session:
+        try:
+            yield session
+            await session.commit()
+        except Exception:
+            await session.rollback()
+            raise
+
+
+def get_pool_stats():
+    return get_engine().pool.wait_stats()
 
 
 def get_or_create(model, defaults=None, **kwargs):
-    # with session_factory() as session:
-        session = session_factory()
-        instance = session.query(model).filter_by(**kwargs).one_or_none()
-        if instance:
-            return instance
+    session = session_factory()
+    instance = session.query(model).filter_by(**kwargs).one_or_none()
+    if instance:
+        return instance
+    else:
+        params = kwargs | (defaults or {})
+        try:
+            with session_scope() as session:
+                session.add(model(**params))
+        except IntegrityError:
+            # someone else created it in the meantime
+            pass
+        return session.query(model).filter_by(**kwargs).one()
+
+
+async def async_get(model, **kwargs):
+    async with async_session_scope() as session:
+        result = await session.execute(select(model).filter_by(**kwargs))
+        return result.scalar_one()
+
+
+async def async_get_or_create(model, defaults=None, **kwargs):
+    async with async_session_scope() as session:
+        result = await session.execute(select(model).filter_by(**kwargs))
+        instance = result.scalar_one_or_none()
+    if instance:
+        return instance
+
+    params = kwargs | (defaults or {})
+    try:
+        async with async_session_scope() as session:
+            session.add(model(**params))
+    except IntegrityError:
+        # someone else created it in the meantime
+        pass
+    return await async_get(model, **kwargs)
+
+
+def to_row(obj, with_relationships=True):
+    # only look at what was explicitly set on the object so that unloaded
+    # attributes of persistent objects don't trigger lazy loads
+    state = inspect(obj)
+    row = {}
+    for attr in state.mapper.column_attrs:
+        if attr.key in state.dict:
+            row[attr.columns[0].key] = state.dict[attr.key]
+
+    if with_relationships:
+        # objects are usually built with job=self instead of job_id=self.id
+        for rel in state.mapper.relationships:
+            related = state.dict.get(rel.key)
+            if rel.direction is not MANYTOONE or related is None:
+                continue
+            for local, remote in rel.local_remote_pairs:
+                if row.get(local.key) is None:
+                    row[local.key] = getattr(related, remote.key)
+    return row
+
+
+def get_writable_columns(table):
+    # generated columns are computed by the db and can't be inserted into
+    return [c for c in table.c if c.computed is None]
+
+
+def prepare_rows(table, rows):
+    # a multi-row VALUES needs the same columns in every row. columns that are
+    # never set (e.g. serial ids) are left out so that the db default applies
+    keys = set()
+    for row in rows:
+        keys.update(k for k, v in row.items() if v is not None)
+
+    cols = [c for c in get_writable_columns(table)
+            if c.key in keys or (c.default is not None and c.default.is_scalar)]
+    prepared = []
+    for row in rows:
+        d = {}
+        for col in cols:
+            val = row.get(col.key)
+            if val is None and col.default is not None and col.default.is_scalar:
+                val = col.default.arg
+            d[col.key] = val
+        prepared.append(d)
+    return prepared
+
+
+def get_insert_query(table, chunk):
+    pk_cols = [c.key for c in table.primary_key]
+    return insert(table).values(chunk)\
+                        .on_conflict_do_nothing(index_elements=pk_cols)
+
+
+def log_failed_row(table, row, ex):
+    _LOG.warning('%s: failed to insert row:[%s] - %s', table.name,
+                 {k: v for k, v in row.items() if not isinstance(v, (dict, list))}, ex.orig)
+
+
+def insert_chunk(table, chunk):
+    # returns (inserted, failed). ON CONFLICT only covers the primary key, so
+    # a chunk that fails on anything else (e.g. a foreign key) is split in
+    # halves until the offending rows are found and only those are dropped
+    try:
+        with session_scope() as session:
+            return session.execute(get_insert_query(table, chunk)).rowcount, 0
+    except IntegrityError as ex:
+        if len(chunk) == 1:
+            log_failed_row(table, chunk[0], ex)
+            return 0, 1
+    mid = len(chunk) // 2
+    left, right = insert_chunk(table, chunk[:mid]), insert_chunk(table, chunk[mid:])
+    return left[0] + right[0], left[1] + right[1]
+
+
+async def async_insert_chunk(table, chunk):
+    try:
+        async with async_session_scope() as session:
+            return (await session.execute(get_insert_query(table, chunk))).rowcount, 0
+    except IntegrityError as ex:
+        if len(chunk) == 1:
+            log_failed_row(table, chunk[0], ex)
+            return 0, 1
+    mid = len(chunk) // 2
+    left, right = await async_insert_chunk(table, chunk[:mid]), await async_insert_chunk(table, chunk[mid:])
+    return left[0] + right[0], left[1] + right[1]
+
+
+def bulk_insert(model, rows, chunk_size):
+    table = model.__table__
+    results = []
+    for chunk in chunkify(rows, chunk_size):
+        chunk = prepare_rows(table, chunk)
+        inserted, failed = insert_chunk(table, chunk)
+
+        result = BulkResult(inserted=inserted, skipped=len(chunk) - inserted - failed, failed=failed)
+        _LOG.debug('%s: inserted:[%s] skipped:[%s] failed:[%s]', table.name, result.inserted, result.skipped,
+                   result.failed)
+        results.append(result)
+    return results
+
+
+async def async_bulk_insert(model, rows, chunk_size):
+    table = model.__table__
+    results = []
+    for chunk in chunkify(rows, chunk_size):
+        chunk = prepare_rows(table, chunk)
+        inserted, failed = await async_insert_chunk(table, chunk)
+
+        result = BulkResult(inserted=inserted, skipped=len(chunk) - inserted - failed, failed=failed)
+        _LOG.debug('%s: inserted:[%s] skipped:[%s] failed:[%s]', table.name, result.inserted, result.skipped,
+                   result.failed)
+        results.append(result)
+    return results
+
+
+def merge_duplicates(rows, key_cols):
+    # ON CONFLICT DO UPDATE can't touch the same row twice in one statement.
+    # a row with a NULL in the key (e.g. no serial id yet) never conflicts,
+    # so it is kept as a row of its own
+    merged = {}
+    for i, row in enumerate(rows):
+        key = tuple(row.get(col) for col in key_cols)
+        if None in key:
+            key = (None, i)
+        if key in merged:
+            old = merged[key]
+            for k, v in row.items():
+                if isinstance(v, dict) and isinstance(old.get(k), dict):
+                    v = dict(old[k], **v)
+                if v is not None:
+                    old[k] = v
         else:
-            params = kwargs | (defaults or {})
-            instance = model(**params)
-            session.add(instance)
-            session.commit()
-            return session.query(model).filter_by(**kwargs).one()
+            merged[key] = dict(row)
+    return list(merged.values())
+
+
+def bulk_upsert(model, rows, conflict_cols, chunk_size, update_cols=()):
+    # JSONB columns are merged into the existing row, update_cols are
+    # overwritten and everything else keeps the value it was inserted with
+    table = model.__table__
+    results = []
+    for chunk in chunkify(rows, chunk_size):
+        chunk = prepare_rows(table, merge_duplicates(chunk, conflict_cols))
+        insert_query = insert(table).values(chunk)
+        merge_cols = [c for c in table.c if isinstance(c.type, JSONB) and c.key in chunk[0]]
+        set_ = {}
+        for col in merge_cols:
+            new_val = func.coalesce(insert_query.excluded[col.key], EMPTY_JSONB)
+            set_[col.key] = func.coalesce(col, EMPTY_JSONB).op('||', return_type=JSONB)(new_val)
+        for key in update_cols:
+            if key in chunk[0]:
+                set_[key] = insert_query.excluded[key]
+        if set_:
+            upsert_query = insert_query.on_conflict_do_update(index_elements=conflict_cols, set_=set_)
+        else:
+            upsert_query = insert_query.on_conflict_do_nothing(index_elements=conflict_cols)
+        # xmax is 0 only for freshly inserted tuples. rows skipped by DO
+        # NOTHING aren't returned at all. an update that sets the values the
+        # row already had still counts as updated, postgres writes it anyway
+        upsert_query = upsert_query.returning(literal_column('(xmax = 0)'))
+        with session_scope() as session:
+            returned = [is_insert for (is_insert,) in session.execute(upsert_query)]
+
+        inserted = sum(1 for is_insert in returned if is_insert)
+        result = UpsertResult(inserted=inserted, updated=len(returned) - inserted, skipped=len(chunk) - len(returned))
+        _LOG.debug('%s: inserted:[%s] updated:[%s] skipped:[%s]',
+                   table.name, result.inserted, result.updated, result.skipped)
+        results.append(result)
+    return results
+
+
+def bulk_update(model, rows, chunk_size):
+    table = model.__table__
+    pk_cols = [c for c in table.primary_key]
+    results = []
+    for chunk in chunkify(rows, chunk_size):
+        chunk = merge_duplicates(chunk, [c.key for c in pk_cols])
+        keys = set()
+        for row in chunk:
+            keys.update(k for k, v in row.items() if v is not None)
+        cols = pk_cols + [c for c in get_writable_columns(table) if c.key in keys and not c.primary_key]
+
+        # untyped VALUES come back as text so every column is cast back to its
+        # real type. NULLs mean "leave as is" and dicts are merged into the
+        # existing JSONB like the old per-object loop did
+        incoming = values(*[column(c.key, c.type) for c in cols], name='incoming')\
+            .data([tuple(row.get(c.key) for c in cols) for row in chunk])
+        set_ = {}
+        for col in cols[len(pk_cols):]:
+            new_val = cast(incoming.c[col.key], col.type)
+            if isinstance(col.type, JSONB):
+                merged = col.op('||', return_type=JSONB)(new_val)
+                set_[col.key] = func.coalesce(merged, new_val, col)
+            else:
+                set_[col.key] = func.coalesce(new_val, col)
+        if not set_:
+            continue
+
+        update_query = table.update()\
+                            .where(and_(*[c == cast(incoming.c[c.key], c.type) for c in pk_cols]))\
+                            .values(set_)
+        with session_scope() as session:
+            updated = session.execute(update_query).rowcount
+
+        result = UpdateResult(updated=updated, missing=len(chunk) - updated)
+        _LOG.debug('%s: updated:[%s] missing:[%s]', table.name, result.updated, result.missing)
+        results.append(result)
+    return results
+
+
+def to_copy_value(val):
+    if val is None:
+        return '\\N'
+    if isinstance(val, (dict, list)):
+        val = json.dumps(val, default=str)
+    elif isinstance(val, (datetime.datetime, datetime.date)):
+        val = val.isoformat()
+    elif isinstance(val, bool):
+        val = 't' if val else 'f'
+    else:
+        val = str(val)
+    return val.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def bulk_copy(model, rows, chunk_size):
+    # rows are streamed with COPY into a temp table (session private and not
+    # WAL-logged) and merged into the real table with a single INSERT
+    table = model.__table__
+    pk_cols = ', '.join(c.name for c in table.primary_key)
+    cols = ', '.join(c.name for c in get_writable_columns(table))
+    staging = 'staging_%s' % table.name
+    start = time.time()
+    total = 0
+    with session_scope() as session:
+        cursor = session.connection().connection.cursor()
+        cursor.execute('CREATE TEMP TABLE %s (LIKE "%s" INCLUDING DEFAULTS) ON COMMIT DROP' % (staging, table.name))
+        for chunk in chunkify(rows, chunk_size):
+            chunk = prepare_rows(table, chunk)
+            chunk_cols = list(chunk[0].keys())
+            buf = io.StringIO()
+            for row in chunk:
+                buf.write('\t'.join(to_copy_value(row[col]) for col in chunk_cols))
+                buf.write('\n')
+            buf.seek(0)
+            cursor.copy_expert('COPY %s (%s) FROM STDIN' % (staging, ', '.join(chunk_cols)), buf)
+            total += len(chunk)
+
+        cursor.execute('INSERT INTO "%s" (%s) SELECT %s FROM %s ON CONFLICT (%s) DO NOTHING'
+                       % (table.name, cols, cols, staging, pk_cols))
+        inserted = cursor.rowcount
+
+    elapsed = time.time() - start
+    _LOG.info('%s: copied:[%s] inserted:[%s] in %.1fs (%d rows/sec)',
+              table.name, total, inserted, elapsed, total / elapsed if elapsed else total)
+    return [BulkResult(inserted=inserted, skipped=total - inserted)]
@@ -0,0 +1,39 @@
+import logging
+
+from sqlalchemy import text
+
+_LOG = logging.getLogger(__name__)
+
+
+def compile_query(query, dialect):
+    statement = getattr(query, 'statement', query)
+    return statement.compile(dialect=dialect, compile_kwargs={'render_postcompile': True})
+
+
+def explain(conn, query):
+    compiled = compile_query(query, conn.dialect)
+    sql = 'EXPLAIN (FORMAT JSON) %s' % compiled
+    return conn.exec_driver_sql(sql, compiled.params).scalar()[0]['Plan']
+
+
+def iter_plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from iter_plan_nodes(child)
+
+
+def get_table_rows(conn):
+    # planner estimates are enough to tell a large table from a small one
+    sql = text("SELECT relname, reltuples FROM pg_class WHERE relkind IN ('r', 'p')")
+    return {relname: reltuples for relname, reltuples in conn.execute(sql)}
+
+
+def get_seq_scans(plan, table_rows, min_rows):
+    seq_scans = []
+    for node in iter_plan_nodes(plan):
+        if node['Node Type'] != 'Seq Scan':
+            continue
+        rows = table_rows.get(node['Relation Name'], 0)
+        if rows >= min_rows:
+            seq_scans.append((node['Relation Name'], rows))
+    return seq_scans
@@ -0,0 +1,38 @@
+import threading
+import time
+
+from sqlalchemy.pool import QueuePool
+
+
+class TimedQueuePool(QueuePool):
+    # QueuePool that keeps track of how long callers wait to check out a
+    # connection, so that an undersized pool shows up as numbers
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _do_get(self):
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        finally:
+            waited = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+
+    def wait_stats(self):
+        with self._stats_lock:
+            return {
+                'checkouts': self.checkouts,
+                'total_wait': self.total_wait,
+                'avg_wait': self.total_wait / self.checkouts if self.checkouts else 0.0,
+                'max_wait': self.max_wait,
+                'checked_out': self.checkedout(),
+                'overflow': self.overflow(),
+                'size': self.size(),
+            }
@@ -0,0 +1,47 @@
+import logging
+import threading
+import time
+
+from community.app import settings
+
+_LOG = logging.getLogger(__name__)
+
+# seconds since the last replayed transaction, or 0 when the replica has
+# replayed everything it received. NULL until the first replay
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+class ReplicaLagCheck(object):
+    # get_lag is only called every REPLICA_LAG_CHECK_INTERVAL seconds so that
+    # routing a read doesn't cost an extra round trip each time
+    def __init__(self, name, get_lag):
+        self.name = name
+        self.get_lag = get_lag
+        self._lock = threading.Lock()
+        self._checked_at = None
+        self._is_usable = False
+
+    def _check(self):
+        try:
+            lag = self.get_lag()
+        except Exception as ex:
+            _LOG.warning('%s: lag check failed - %s', self.name, ex)
+            return False
+        if lag is None or lag > settings.REPLICA_MAX_LAG_SECONDS:
+            _LOG.warning('%s: lag:[%s] is above %ss. reading from primary',
+                         self.name, lag, settings.REPLICA_MAX_LAG_SECONDS)
+            return False
+        return True
+
+    def is_usable(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._checked_at is None or now - self._checked_at >= settings.REPLICA_LAG_CHECK_INTERVAL:
+                self._is_usable = self._check()
+                self._checked_at = now
+            return self._is_usable
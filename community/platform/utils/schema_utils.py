@@ -0,0 +1,248 @@
+import datetime
+import logging
+
+from sqlalchemy import inspect, text
+from sqlalchemy.schema import AddConstraint, UniqueConstraint
+
+from community.app import settings
+
+_LOG = logging.getLogger(__name__)
+
+
+def relation_exists(conn, name):
+    return conn.execute(text('SELECT to_regclass(:name)'), {'name': '"%s"' % name}).scalar() is not None
+
+
+def is_partitioned(table):
+    return bool(table.dialect_options['postgresql'].get('partition_by'))
+
+
+def add_missing_columns(conn, table):
+    # generated columns are derived from other columns and nullable ones start
+    # out empty, so both can be added to existing tables without a backfill
+    existing = {c['name'] for c in inspect(conn).get_columns(table.name)}
+    ddl_compiler = conn.dialect.ddl_compiler(conn.dialect, None)
+    for col in table.c:
+        if col.name in existing or (col.computed is None and not col.nullable):
+            continue
+        _LOG.info('adding column %s.%s', table.name, col.name)
+        conn.execute(text('ALTER TABLE "%s" ADD COLUMN %s' % (table.name, ddl_compiler.get_column_specification(col))))
+
+
+def add_missing_indexes(conn, table):
+    # create_all only creates indexes for tables it creates itself
+    for index in table.indexes:
+        if not relation_exists(conn, index.name):
+            _LOG.info('creating index %s', index.name)
+            index.create(conn)
+
+
+def add_missing_unique_constraints(conn, table):
+    inspector = inspect(conn)
+    existing = {tuple(c['column_names']) for c in inspector.get_unique_constraints(table.name)}
+    existing.update(tuple(ix['column_names']) for ix in inspector.get_indexes(table.name) if ix['unique'])
+    for constraint in table.constraints:
+        if not isinstance(constraint, UniqueConstraint):
+            continue
+        cols = tuple(c.name for c in constraint.columns)
+        if cols in existing:
+            continue
+
+        _LOG.info('adding unique constraint on %s%s', table.name, cols)
+        remove_duplicates(conn, table, cols)
+        conn.execute(AddConstraint(constraint))
+
+
+def remove_duplicates(conn, table, cols):
+    # older rows may violate a new unique constraint. the copy with the
+    # latest id is kept. NULLs never collide, like in the constraint itself
+    not_null = ' AND '.join('%s IS NOT NULL' % col for col in cols)
+    count = conn.execute(text('SELECT coalesce(sum(n - 1), 0) FROM (SELECT count(*) AS n FROM "%s" WHERE %s '
+                              'GROUP BY %s HAVING count(*) > 1) d'
+                              % (table.name, not_null, ', '.join(cols)))).scalar()
+    if not count:
+        return
+    if 'id' not in table.c:
+        raise RuntimeError('%s has %s rows that duplicate %s and no id to pick the copy to keep by. '
+                           'remove them by hand and migrate again' % (table.name, count, cols))
+
+    _LOG.warning('%s: removing %s rows that duplicate %s, keeping the latest id', table.name, count, cols)
+    match = ' AND '.join('a.%s = b.%s' % (col, col) for col in cols)
+    result = conn.execute(text('DELETE FROM "%s" a USING "%s" b WHERE a.id < b.id AND %s'
+                               % (table.name, table.name, match)))
+    _LOG.warning('%s: removed %s duplicate rows', table.name, result.rowcount)
+
+
+def get_models(table):
+    from community.models import Base
+
+    return [mapper.class_ for mapper in Base.registry.mappers if mapper.local_table is table]
+
+
+def backfill_new_table(conn, table):
+    # tables that replace a column (like a link table) are filled from the
+    # old data the first time they come up empty
+    for model in get_models(table):
+        if not hasattr(model, 'get_backfill_query'):
+            continue
+        has_rows = conn.execute(text('SELECT EXISTS (SELECT 1 FROM "%s")' % table.name)).scalar()
+        if not has_rows:
+            _LOG.info('backfilling %s', table.name)
+            conn.execute(model.get_backfill_query())
+
+
+def fix_existing_rows(conn, table):
+    # one-off data fixes for rows written under an older definition. each fix
+    # runs once, in the migrate transaction, and is recorded in schema_fixup
+    # so that later deploys don't scan the table again
+    fixups = [fixup for model in get_models(table) for fixup in getattr(model, 'get_fixups', lambda: [])()]
+    if not fixups:
+        return
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_fixup (name text PRIMARY KEY, applied_on timestamp NOT NULL)'))
+    for name, queries in fixups:
+        is_applied = conn.execute(text('SELECT EXISTS (SELECT 1 FROM schema_fixup WHERE name = :name)'),
+                                  {'name': name}).scalar()
+        if is_applied:
+            continue
+        for query in queries:
+            result = conn.execute(query)
+            if result.rowcount:
+                _LOG.info('%s: fixed %s rows of %s', name, result.rowcount, table.name)
+        conn.execute(text('INSERT INTO schema_fixup (name, applied_on) VALUES (:name, now())'), {'name': name})
+
+
+def month_floor(dt):
+    return datetime.datetime(dt.year, dt.month, 1)
+
+
+def next_month(dt):
+    return datetime.datetime(dt.year + dt.month // 12, dt.month % 12 + 1, 1)
+
+
+def get_partition_name(table, month):
+    return '%s_y%04dm%02d' % (table.name, month.year, month.month)
+
+
+def get_default_partition_name(table):
+    return '%s_default' % table.name
+
+
+def create_partition(conn, table, month):
+    name = get_partition_name(table, month)
+    if relation_exists(conn, name):
+        return
+
+    # rows for this month may already sit in the default partition, in which
+    # case postgres refuses to add the partition until they are moved out
+    default = get_default_partition_name(table)
+    cols = ', '.join(c.name for c in table.c if c.computed is None)
+    in_month = "timestamp >= '%s' AND timestamp < '%s'" % (month.isoformat(), next_month(month).isoformat())
+    has_rows = conn.execute(text('SELECT EXISTS (SELECT 1 FROM "%s" WHERE %s)' % (default, in_month))).scalar()
+
+    _LOG.info('creating partition %s', name)
+    if has_rows:
+        conn.execute(text('ALTER TABLE "%s" DETACH PARTITION "%s"' % (table.name, default)))
+    conn.execute(text("CREATE TABLE \"%s\" PARTITION OF \"%s\" FOR VALUES FROM ('%s') TO ('%s')"
+                      % (name, table.name, month.isoformat(), next_month(month).isoformat())))
+    if has_rows:
+        conn.execute(text('INSERT INTO "%s" (%s) SELECT %s FROM "%s" WHERE %s' % (name, cols, cols, default, in_month)))
+        conn.execute(text('DELETE FROM "%s" WHERE %s' % (default, in_month)))
+        conn.execute(text('ALTER TABLE "%s" ATTACH PARTITION "%s" DEFAULT' % (table.name, default)))
+
+
+def create_partitions(conn, table, since=None, months_ahead=None):
+    # the default partition catches rows outside of the known months (old
+    # backfills, clock skew) until their month gets a partition of its own
+    default = get_default_partition_name(table)
+    conn.execute(text('CREATE TABLE IF NOT EXISTS "%s" PARTITION OF "%s" DEFAULT' % (default, table.name)))
+
+    if months_ahead is None:
+        months_ahead = settings.DB_PARTITION_MONTHS_AHEAD
+    now = datetime.datetime.now()
+    oldest = conn.execute(text('SELECT min(timestamp) FROM "%s"' % default)).scalar()
+    month = month_floor(min(filter(None, [since, oldest, now])))
+    end = month_floor(now)
+    for _ in range(months_ahead):
+        end = next_month(end)
+    while month <= end:
+        create_partition(conn, table, month)
+        month = next_month(month)
+
+
+def partition_existing_table(conn, table):
+    # moves the rows of a table created before it was partitioned into a
+    # partitioned copy. the old table is kept around to be dropped by hand
+    if not is_partitioned(table) or not relation_exists(conn, table.name):
+        return
+    is_already_partitioned = conn.execute(text('SELECT EXISTS (SELECT 1 FROM pg_partitioned_table '
+                                               'WHERE partrelid = to_regclass(:name))'),
+                                          {'name': '"%s"' % table.name}).scalar()
+    if is_already_partitioned:
+        return
+
+    legacy = '%s_unpartitioned' % table.name
+    _LOG.info('moving %s to %s', table.name, legacy)
+    conn.execute(text('ALTER TABLE "%s" RENAME TO "%s"' % (table.name, legacy)))
+    indexes = conn.execute(text('SELECT indexname FROM pg_indexes WHERE tablename = :name'), {'name': legacy})
+    for (index_name,) in indexes.fetchall():
+        conn.execute(text('ALTER INDEX "%s" RENAME TO "%s_unpartitioned"' % (index_name, index_name[:48])))
+
+    table.create(conn)
+    since = conn.execute(text('SELECT min(timestamp) FROM "%s"' % legacy)).scalar()
+    create_partitions(conn, table, since=since)
+
+    # columns added to the model since the old table was created are left to
+    # their defaults, add_missing_columns only runs after this
+    legacy_cols = {c['name'] for c in inspect(conn).get_columns(legacy)}
+    cols = ', '.join(c.name for c in table.c if c.computed is None and c.name in legacy_cols)
+    conn.execute(text('INSERT INTO "%s" (%s) SELECT %s FROM "%s" ON CONFLICT DO NOTHING'
+                      % (table.name, cols, cols, legacy)))
+    _LOG.warning('%s has been partitioned. drop %s once the data has been verified', table.name, legacy)
+
+
+def ensure_partitions(conn, table):
+    if is_partitioned(table):
+        create_partitions(conn, table)
+
+
+BEFORE_CREATE_MIGRATIONS = [
+    partition_existing_table,
+]
+AFTER_CREATE_MIGRATIONS = [
+    add_missing_columns,
+    add_missing_indexes,
+    add_missing_unique_constraints,
+    ensure_partitions,
+    fix_existing_rows,
+    backfill_new_table,
+]
+
+
+def get_tables():
+    from community.models import Base, import_models
+
+    import_models()
+    return Base.metadata.sorted_tables
+
+
+def bootstrap():
+    from community.models import Base
+    from community.platform.utils.orm_utils import get_engine
+
+    tables = get_tables()
+    with get_engine().begin() as conn:
+        for table in tables:
+            for migration in BEFORE_CREATE_MIGRATIONS:
+                migration(conn, table)
+        Base.metadata.create_all(conn)
+        for table in tables:
+            for migration in AFTER_CREATE_MIGRATIONS:
+                migration(conn, table)
+
+
+def maintain_partitions():
+    from community.platform.utils.orm_utils import get_engine
+
+    with get_engine().begin() as conn:
+        for table in get_tables():
+            ensure_partitions(conn, table)
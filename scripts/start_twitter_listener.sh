@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+
+VIRTUALENV_BIN=/home/ubuntu/virtual_env/community/bin
+cd /home/ubuntu/Community
+source $VIRTUALENV_BIN/activate && source $VIRTUALENV_BIN/postactivate
+
+echo "${1-start}ing twitter listener"
+$VIRTUALENV_BIN/python -m community.commands.twitter_listener $1